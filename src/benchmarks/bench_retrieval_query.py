@@ -0,0 +1,95 @@
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'streamlit'))
+from neo4j_driver import get_driver
+from retrievers import NEIGHBOUR_WINDOW, vector_index_query
+
+# Vector index search run before the retrieval query of Neo4jVector
+index_call = """
+CALL db.index.vector.queryNodes('chunkVectorIndex', $k, $embedding) YIELD node, score
+"""
+
+# Retrieval query used by qa_rag_chain before the anchored query, kept to compare against it
+legacy_query = """
+WITH node AS doc, score AS similarity
+ORDER BY similarity DESC LIMIT 5
+CALL {
+    WITH doc
+    MATCH (e:Embedding)-[:HAS_EMBEDDING]->(chunk:Chunk)
+    OPTIONAL MATCH (chunk)-[:HAS_PARENT]->(section:Section)
+    OPTIONAL MATCH (section)-[:HAS_DOCUMENT]->(document:Document)
+    RETURN chunk AS result, section, document}
+WITH result, section, document, similarity
+RETURN
+    result.sentences AS text,
+    similarity AS score,
+    {documentName: document.name,
+    sectionTitle: section.title,
+    pageIndex: result.page_idx} AS metadata
+"""
+
+# Stored vectors used as questions when no questions are given
+sample_query = """
+MATCH (e:Embedding) WITH e, rand() AS r ORDER BY r LIMIT $n RETURN e.value AS value
+"""
+
+def sample_embeddings(session, n, questions=None):
+    if questions:
+        from embedding_backend import EmbeddingBackend
+        return EmbeddingBackend().embed_documents(questions)
+    return [json.loads(record["value"]) if isinstance(record["value"], str) else record["value"]
+            for record in session.run(sample_query, n=n)]
+
+def db_hits(plan):
+    return plan.get("dbHits", 0) + sum(db_hits(child) for child in plan.get("children", []))
+
+def run_query(session, query, embeddings, k, runs, profile=False):
+    """Function that runs a retrieval query once per embedding and runs times,
+    returning the latency percentiles, the rows returned and the database hits"""
+
+    session.run(query, k=k, embedding=embeddings[0]).consume() #Warmup
+    latencies = []
+    rows = []
+    for _ in range(runs):
+        for embedding in embeddings:
+            start = time.perf_counter()
+            rows.append(len(session.run(query, k=k, embedding=embedding).data()))
+            latencies.append(time.perf_counter() - start)
+    result = {"p50_ms": statistics.median(latencies) * 1000,
+              "p95_ms": sorted(latencies)[int(0.95 * (len(latencies) - 1))] * 1000,
+              "mean_rows": statistics.mean(rows)}
+    if profile:
+        hits = [db_hits(session.run("PROFILE " + query, k=k, embedding=embedding).consume().profile)
+                for embedding in embeddings]
+        result["mean_db_hits"] = statistics.mean(hits)
+    return result
+
+def main(k=5, n=20, runs=3, window=NEIGHBOUR_WINDOW, profile=False, questions=None):
+    with get_driver().session() as session:
+        embeddings = sample_embeddings(session, n, questions)
+        if not embeddings:
+            print('NO EMBEDDINGS FOUND IN NEO4J')
+            return {}
+        results = {"legacy": run_query(session, index_call + legacy_query, embeddings, k, runs, profile),
+                   "anchored": run_query(session, index_call + vector_index_query(window), embeddings, k, runs, profile)}
+    for name, result in results.items():
+        print(f'{name}: {json.dumps(result)}')
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the legacy and the anchored retrieval queries of Neo4jVector')
+    parser.add_argument('--k', type=int, default=5, help='hits of the vector index')
+    parser.add_argument('--samples', type=int, default=20, help='stored vectors used as questions')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--window', type=int, default=NEIGHBOUR_WINDOW, help='neighbouring chunks added on each side')
+    parser.add_argument('--profile', action='store_true', help='also count the database hits with PROFILE')
+    parser.add_argument('--questions', nargs='+', help='questions embedded with the embedding model instead of stored vectors')
+    args = parser.parse_args()
+
+    main(args.k, args.samples, args.runs, args.window, args.profile, args.questions)
@@ -0,0 +1,90 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SRC_LOCATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Each target is imported in a new interpreter, then its first request is run:
+# (folder, module, code of the first request)
+TARGETS = {
+    'chains_rag': ('streamlit', 'chains_rag',
+                   'embeddings, dimension = module.load_embedding()\n'
+                   'embeddings.embed_query("¿Cuál es la duración del contrato?")\n'
+                   'module.llm_chain(module.load_llm("gpt-3.5"))'),
+    'chat_service': ('streamlit', 'chat_service',
+                     'module.default_service()'),
+    'embedding_data': ('load-data-neo4j', 'embedding_data',
+                       'module.embedding_model().embed_query("¿Cuál es la duración del contrato?")'),
+}
+
+RUNNER = '''
+import importlib, json, sys, time
+start = time.perf_counter()
+module = importlib.import_module({module!r})
+imported = time.perf_counter()
+result = {{"import_s": imported - start, "torch_on_import": "torch" in sys.modules}}
+if {first_request!r}:
+    exec({first_request!r})
+    result["first_request_s"] = time.perf_counter() - imported
+print("BENCH " + json.dumps(result))
+'''
+
+def run_target(name, first_request=True, importtime=False):
+    """Function that imports a target module in a new interpreter and measures
+    the import time and the time of its first request"""
+
+    folder, module, request_code = TARGETS[name]
+    code = RUNNER.format(module=module, first_request=request_code if first_request else '')
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', code]
+    process = subprocess.run(command, cwd=os.path.join(SRC_LOCATION, folder), capture_output=True, text=True)
+    lines = [line for line in process.stdout.splitlines() if line.startswith('BENCH ')]
+    if process.returncode != 0 or not lines:
+        raise RuntimeError(f'{name} failed:\n{process.stderr[-2000:]}')
+    result = json.loads(lines[-1][len('BENCH '):])
+    if importtime:
+        result['slowest_imports'] = slowest_imports(process.stderr)
+    return result
+
+def slowest_imports(stderr, n=10):
+    """Function that returns the n modules with the highest cumulative import time
+    from the output of python -X importtime"""
+
+    imports = []
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, module = line[len('import time:'):].split('|')
+            if cumulative.strip().isdigit():
+                imports.append((int(cumulative) / 1e6, module.strip()))
+    return sorted(imports, reverse=True)[:n]
+
+def main(targets, runs, first_request, importtime):
+    results = {}
+    for name in targets:
+        samples = [run_target(name, first_request) for _ in range(runs)]
+        results[name] = {
+            'import_s_median': statistics.median(s['import_s'] for s in samples),
+            'torch_on_import': any(s['torch_on_import'] for s in samples),
+        }
+        if first_request:
+            results[name]['first_request_s_median'] = statistics.median(s['first_request_s'] for s in samples)
+        if importtime:
+            results[name]['slowest_imports'] = run_target(name, False, True)['slowest_imports']
+        print(f'{name}: {json.dumps(results[name], indent=2)}')
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Cold start benchmark: import and first request latency of the app and loaders')
+    parser.add_argument('--targets', nargs='+', choices=list(TARGETS), default=list(TARGETS))
+    parser.add_argument('--runs', type=int, default=3, help='new interpreters started for each target')
+    parser.add_argument('--import-only', action='store_true', help='do not run the first request')
+    parser.add_argument('--importtime', action='store_true', help='also print the slowest imports of each target')
+    parser.add_argument('--output', help='json file where the results are saved')
+    args = parser.parse_args()
+
+    results = main(args.targets, args.runs, not args.import_only, args.importtime)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,407 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+BENCH_LOCATION = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BENCH_LOCATION, '..'))
+sys.path.append(os.path.join(BENCH_LOCATION, '..', 'streamlit'))
+sys.path.append(os.path.join(BENCH_LOCATION, '..', 'load-data-neo4j'))
+import instrumentation
+from fakes import FakeDriver, FakeEmbeddings, FakeStreamingChatModel
+from synthetic_docs import CLAUSES, synthetic_document
+
+RESULTS_LOCATION = os.path.join(BENCH_LOCATION, 'results')
+SCENARIOS = ['ingestion', 'embedding', 'retrieval', 'end_to_end', 'chat_service', 'ticket']
+# Relative change of a latency percentile or a throughput counted as a regression
+REGRESSION_THRESHOLD = 0.10
+
+TICKET_ANSWER = "Title: Duración del contrato\nQuestion: ¿Cuál es la duración del contrato y cómo se prorroga?"
+
+def stats(latencies, wall, items=None):
+    """Function that summarizes the latencies of a scenario: throughput
+    (items per second of wall time) and p50/p95/p99 in milliseconds"""
+
+    latencies = np.array(latencies) * 1000
+    return {"count": len(latencies),
+            "throughput_per_s": (items if items is not None else len(latencies)) / wall if wall else 0.0,
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p95_ms": float(np.percentile(latencies, 95)),
+            "p99_ms": float(np.percentile(latencies, 99))}
+
+def quiet():
+    # The loaders print a summary for each document and page
+    return contextlib.redirect_stdout(io.StringIO())
+
+def questions(n):
+    return [CLAUSES[i % len(CLAUSES)].format(n=i) for i in range(n)]
+
+class TimedEmbeddings(Embeddings):
+    """Embedder that records the latency of each call of the wrapped embedder"""
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        self.latencies = []
+
+    def embed_documents(self, texts):
+        start = time.perf_counter()
+        vectors = self.embeddings.embed_documents(texts)
+        self.latencies.append(time.perf_counter() - start)
+        return vectors
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+class Bench:
+    """Benchmark scenarios run against the fakes or, with neo4j_uri, against
+    a local Neo4j instance that the ingestion scenario fills with synthetic contracts"""
+
+    def __init__(self, documents=10, doc_kwargs=None, batch_size=1000, page_size=512, queries=50,
+                 db_latency=0.0, embed_cost=0.0, first_token_delay=0.0, token_delay=0.0,
+                 neo4j_uri=None, neo4j_user='neo4j', neo4j_password=None):
+        self.documents = documents
+        self.doc_kwargs = doc_kwargs or {}
+        self.batch_size = batch_size
+        self.page_size = page_size
+        self.queries = queries
+        self.db_latency = db_latency
+        self.embeddings = FakeEmbeddings(cost=embed_cost)
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+        self.neo4j_uri = neo4j_uri
+        self.neo4j_user = neo4j_user
+        self.neo4j_password = neo4j_password
+        self.local_index = None
+
+    def driver(self, responder=None):
+        if self.neo4j_uri:
+            from neo4j_driver import get_driver
+            return get_driver(self.neo4j_uri, self.neo4j_user, self.neo4j_password)
+        return FakeDriver(responder, latency=self.db_latency)
+
+    def document(self, i):
+        return synthetic_document(seed=i, **self.doc_kwargs), f'/benchmark/contrato-{i}.pdf'
+
+    def ingestion(self):
+        import load_data
+
+        driver = self.driver()
+        latencies = []
+        chunks = 0
+        start = time.perf_counter()
+        for i in range(self.documents):
+            doc, location = self.document(i)
+            doc_start = time.perf_counter()
+            with quiet():
+                load_data.processpdfNeo4jBatch(doc, location, self.batch_size, driver)
+            latencies.append(time.perf_counter() - doc_start)
+            chunks += len(doc.chunks())
+        wall = time.perf_counter() - start
+        return {**stats(latencies, wall), "chunks_per_s": chunks / wall}
+
+    def embedding(self):
+        import embedding_data
+
+        texts = []
+        if not self.neo4j_uri:
+            for i in range(self.documents):
+                doc, _ = self.document(i)
+                texts += ['Sección >> ' + "\n".join(chunk.sentences) for chunk in doc.chunks() if chunk.tag != 'table']
+
+        def responder(query, params):
+            # Pending count and pages of nodes without embeddings read by create_embedding_batched
+            if "count(chunk) AS total" in query:
+                return [{"total": max(len(texts) - params["last_id"] - 1, 0)}]
+            if "embedding_created IS NULL" in query:
+                first = params["last_id"] + 1
+                return [{"id": i, "text": texts[i]} for i in range(first, min(first + params["page_size"], len(texts)))]
+            return []
+
+        embed_model = TimedEmbeddings(self.embeddings)
+        start = time.perf_counter()
+        with quiet():
+            count = embedding_data.create_embedding_batched("Chunk", "sentences", embed_model, self.page_size, self.driver(responder),
+                                                            checkpoint=False)
+        wall = time.perf_counter() - start
+        return {**stats(embed_model.latencies or [0.0], wall, count or 0), "nodes": count or 0}
+
+    def build_local_index(self):
+        import load_data
+        from local_index import LocalVectorIndex
+
+        rows = []
+        for i in range(self.documents):
+            doc, location = self.document(i)
+            _, _, doc_rows = load_data.collect_doc_rows(doc, location)
+            for row in doc_rows["chunks"]:
+                rows.append({"id": len(rows), "value": self.embeddings.vector(row["sentences"]), "key": row["key"],
+                             "text": row["sentences"], "sectionTitle": row["section_path"].split(' > ')[-1],
+                             "sectionKey": None, "pageIndex": row["page_idx"]})
+
+        def responder(query, params):
+            if "collect(d.name) AS names" in query:
+                return [{"now": 0, "names": []}]
+            if "count(e) AS total" in query:
+                return [{"total": len(rows)}]
+            first = params["last_id"] + 1
+            return rows[first:first + params["page_size"]]
+
+        index = LocalVectorIndex(location=tempfile.mkdtemp(prefix='bench-vector-index-'))
+        index.refresh(FakeDriver(responder))
+        return index
+
+    def retriever(self):
+        from context_packer import PackingRetriever, context_budget
+        from local_index import LocalVectorRetriever
+        from retrievers import ContractRetriever
+
+        if self.neo4j_uri:
+            base = ContractRetriever(driver=self.driver(), embeddings=self.embeddings, doc_name='contrato-0', k=8)
+        else:
+            if self.local_index is None:
+                self.local_index = self.build_local_index()
+            base = LocalVectorRetriever(index=self.local_index, embeddings=self.embeddings, k=8, doc_name='contrato-0')
+        return PackingRetriever(retriever=base, budget=context_budget('gpt-3.5-turbo'))
+
+    def retrieval(self):
+        retriever = self.retriever()
+        latencies = []
+        start = time.perf_counter()
+        for question in questions(self.queries):
+            query_start = time.perf_counter()
+            retriever.get_relevant_documents(question)
+            latencies.append(time.perf_counter() - query_start)
+        return stats(latencies, time.perf_counter() - start)
+
+    def chains_rag(self):
+        import chains_rag
+        if not self.neo4j_uri:
+            # The connection check of the chains would wait for the configured Neo4j instance
+            chains_rag.testnodes_neo4j = lambda *args, **kwargs: None
+        return chains_rag
+
+    def end_to_end(self):
+        from langchain_core.callbacks import BaseCallbackHandler
+
+        chains_rag = self.chains_rag()
+        llm = FakeStreamingChatModel(first_token_delay=self.first_token_delay, token_delay=self.token_delay)
+        if self.neo4j_uri:
+            chain = chains_rag.qa_rag_chain(llm, self.embeddings, self.neo4j_uri, self.neo4j_user, self.neo4j_password,
+                                            'neo4j', 'contrato-0')
+        else:
+            if self.local_index is None:
+                self.local_index = self.build_local_index()
+            chain = chains_rag.qa_rag_chain(llm, self.embeddings, None, None, None, 'neo4j', 'contrato-0',
+                                            local_index=self.local_index)
+
+        class FirstToken(BaseCallbackHandler):
+            def __init__(self):
+                self.time = None
+
+            def on_llm_new_token(self, token, **kwargs):
+                if self.time is None:
+                    self.time = time.perf_counter()
+
+        latencies = []
+        first_tokens = []
+        start = time.perf_counter()
+        for question in questions(self.queries):
+            handler = FirstToken()
+            query_start = time.perf_counter()
+            with quiet():
+                chain({"question": question, "input_text": question}, callbacks=[handler])
+            latencies.append(time.perf_counter() - query_start)
+            first_tokens.append((handler.time or time.perf_counter()) - query_start)
+        result = stats(latencies, time.perf_counter() - start)
+        first = np.array(first_tokens) * 1000
+        result.update({"first_token_p50_ms": float(np.percentile(first, 50)),
+                       "first_token_p95_ms": float(np.percentile(first, 95)),
+                       "first_token_p99_ms": float(np.percentile(first, 99))})
+        return result
+
+    def chat_service(self):
+        """Answers RAG questions through the /chat endpoint of the HTTP API with the fake
+        llm and the same retrieval as end_to_end. A request that does not end with an
+        'answer' event fails the scenario"""
+
+        import asyncio
+        from aiohttp.test_utils import TestClient, TestServer
+        from chat_service import ChatService, create_app
+
+        chains_rag = self.chains_rag()
+        if not self.neo4j_uri and self.local_index is None:
+            self.local_index = self.build_local_index()
+
+        def llm_factory(llm_name):
+            return FakeStreamingChatModel(first_token_delay=self.first_token_delay, token_delay=self.token_delay)
+
+        def rag_chain_factory(llm, embeddings, contract_name):
+            if self.neo4j_uri:
+                return chains_rag.qa_rag_chain(llm, embeddings, self.neo4j_uri, self.neo4j_user, self.neo4j_password,
+                                               'neo4j', contract_name)
+            return chains_rag.qa_rag_chain(llm, embeddings, None, None, None, 'neo4j', contract_name,
+                                           local_index=self.local_index)
+
+        service = ChatService(llm_factory=llm_factory, embeddings=self.embeddings, llm_chain_factory=chains_rag.llm_chain,
+                              rag_chain_factory=rag_chain_factory, ticket_fn=chains_rag.llm_ticket, health_fn=lambda: True)
+
+        async def run():
+            latencies = []
+            async with TestClient(TestServer(create_app(service))) as client:
+                start = time.perf_counter()
+                for question in questions(self.queries):
+                    query_start = time.perf_counter()
+                    response = await client.post('/chat', json={"question": question, "rag": True, "contract": 'contrato-0'})
+                    body = await response.text()
+                    latencies.append(time.perf_counter() - query_start)
+                    if response.status != 200 or 'event: answer' not in body:
+                        raise RuntimeError(f'/chat did not answer {question!r}: {body[-300:]}')
+                wall = time.perf_counter() - start
+
+                for data in ('{"question": ', '["question"]', '{"question": "hola", "llm": "unknown"}'):
+                    response = await client.post('/chat', data=data, headers={"Content-Type": "application/json"})
+                    if response.status != 400:
+                        raise RuntimeError(f'/chat answered {response.status} to the invalid body {data}')
+                return stats(latencies, wall)
+
+        async def cancellation():
+            # The llm takes 2 seconds per answer and the requests are cut after 0.1 seconds:
+            # the worker must stop at its next token and only then free its slot
+            slow = ChatService(llm_factory=lambda llm_name: FakeStreamingChatModel(answer='palabra ' * 200, token_delay=0.01),
+                               embeddings=self.embeddings, llm_chain_factory=chains_rag.llm_chain,
+                               rag_chain_factory=rag_chain_factory, ticket_fn=chains_rag.llm_ticket, health_fn=lambda: True,
+                               request_timeout=0.1)
+            request = {"question": "duración del contrato", "rag": True, "contract": 'contrato-0'}
+            async with TestClient(TestServer(create_app(slow))) as client:
+                response = await client.post('/chat', json=request)
+                if 'event: error' not in await response.text():
+                    raise RuntimeError('/chat did not time out')
+                await self.wait_idle(slow, 'timeout')
+
+                response = await client.post('/chat', json={**request, "question": "otra pregunta"})
+                await response.content.readline()
+                response.close()
+                await self.wait_idle(slow, 'disconnect')
+
+        with quiet():
+            result = asyncio.run(run())
+            asyncio.run(cancellation())
+        return result
+
+    async def wait_idle(self, service, cause, limit=0.5):
+        import asyncio
+        start = time.perf_counter()
+        while service.inflight:
+            if time.perf_counter() - start > limit:
+                raise RuntimeError(f'/chat kept generating {limit}s after the {cause}')
+            await asyncio.sleep(0.01)
+
+    def ticket(self):
+        chains_rag = self.chains_rag()
+        llm = FakeStreamingChatModel(answer=TICKET_ANSWER, first_token_delay=self.first_token_delay, token_delay=self.token_delay)
+        latencies = []
+        start = time.perf_counter()
+        for question in questions(self.queries):
+            query_start = time.perf_counter()
+            with quiet():
+                chains_rag.llm_ticket(question, llm)
+            latencies.append(time.perf_counter() - query_start)
+        return stats(latencies, time.perf_counter() - start)
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_LOCATION,
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """Function that compares the results of a run with a saved baseline.
+    Returns the regressions: latency percentiles higher or throughputs lower
+    than the baseline by more than threshold"""
+
+    regressions = []
+    for scenario, metrics in results.items():
+        for metric, value in metrics.items():
+            previous = baseline.get(scenario, {}).get(metric)
+            if not previous or metric == "count" or not isinstance(value, (int, float)):
+                continue
+            change = (value - previous) / previous
+            worse = change > threshold if metric.endswith('_ms') else change < -threshold
+            print(f'{scenario:12} {metric:22} {previous:12.3f} -> {value:12.3f} ({change:+.1%}){"  REGRESSION" if worse else ""}')
+            if worse:
+                regressions.append((scenario, metric, previous, value))
+    return regressions
+
+def main(bench, scenarios, output=None, baseline=None, threshold=REGRESSION_THRESHOLD, stages=False):
+    """Function that runs the scenarios and saves their results. With stages the spans of
+    the instrumentation are also recorded and their histograms saved with the results"""
+
+    os.makedirs(RESULTS_LOCATION, exist_ok=True)
+    output = output or os.path.join(RESULTS_LOCATION, f'bench-{datetime.now().strftime("%Y%m%d-%H%M%S")}.json')
+    if stages:
+        instrumentation.configure('json', path=output[:-len('.json')] + '-stages.json')
+
+    results = {}
+    for scenario in scenarios:
+        results[scenario] = getattr(bench, scenario)()
+        print(f'{scenario}: {json.dumps(results[scenario])}')
+
+    run = {"timestamp": datetime.now().isoformat(timespec='seconds'),
+           "commit": git_commit(),
+           "target": bench.neo4j_uri or "fake",
+           "results": results}
+    if stages:
+        run["stages"] = instrumentation.snapshot()["histograms"]
+    with open(output, 'w') as f:
+        json.dump(run, f, indent=2)
+    print(f'RESULTS SAVED TO {output}')
+
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f)["results"], threshold)
+        print(f'REGRESSIONS: {len(regressions)}')
+        return regressions
+    return []
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark of ingestion, embedding, retrieval, answers and tickets with local stand-ins')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--documents', type=int, default=10, help='synthetic contracts')
+    parser.add_argument('--sections', type=int, default=8)
+    parser.add_argument('--subsections', type=int, default=2)
+    parser.add_argument('--chunks', type=int, default=4, help='chunks of each section')
+    parser.add_argument('--tables', type=int, default=1, help='tables of each section')
+    parser.add_argument('--queries', type=int, default=50, help='questions of the retrieval, answer and ticket scenarios')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--page-size', type=int, default=512)
+    parser.add_argument('--db-latency-ms', type=float, default=0.0, help='simulated round trip of each statement of the fake driver')
+    parser.add_argument('--embed-cost-ms', type=float, default=0.0, help='simulated encoding time of each text')
+    parser.add_argument('--first-token-ms', type=float, default=0.0, help='simulated time to the first token of the llm')
+    parser.add_argument('--token-ms', type=float, default=0.0, help='simulated time between tokens of the llm')
+    parser.add_argument('--neo4j-uri', help='run against a local Neo4j instance instead of the fake driver')
+    parser.add_argument('--neo4j-user', default='neo4j')
+    parser.add_argument('--neo4j-password')
+    parser.add_argument('--output', help='json file of the results, by default in src/benchmarks/results')
+    parser.add_argument('--baseline', help='results of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument('--stages', action='store_true', help='also record the duration of each stage with the instrumentation spans')
+    args = parser.parse_args()
+
+    bench = Bench(documents=args.documents,
+                  doc_kwargs={"sections": args.sections, "subsections": args.subsections,
+                              "chunks": args.chunks, "tables": args.tables},
+                  batch_size=args.batch_size, page_size=args.page_size, queries=args.queries,
+                  db_latency=args.db_latency_ms / 1000, embed_cost=args.embed_cost_ms / 1000,
+                  first_token_delay=args.first_token_ms / 1000, token_delay=args.token_ms / 1000,
+                  neo4j_uri=args.neo4j_uri, neo4j_user=args.neo4j_user, neo4j_password=args.neo4j_password)
+    regressions = main(bench, args.scenarios, args.output, args.baseline, args.threshold, args.stages)
+    sys.exit(1 if regressions else 0)
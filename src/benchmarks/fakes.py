@@ -0,0 +1,135 @@
+import hashlib
+import re
+import threading
+import time
+from typing import Any, List, Optional
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import SimpleChatModel
+
+class FakeResult:
+    """Result of a FakeSession.run with the records given by the responder"""
+
+    def __init__(self, records):
+        self.records = records
+
+    def data(self):
+        return [dict(record) for record in self.records]
+
+    def single(self):
+        return self.records[0] if self.records else None
+
+    def consume(self):
+        return None
+
+    def __iter__(self):
+        return iter(self.records)
+
+class Recorder:
+    """Statements run by the sessions of a FakeDriver: count, rows sent in
+    UNWIND parameter lists and time spent answering them"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.statements = 0
+        self.rows = 0
+        self.queries = []
+
+    def record(self, query, params, keep):
+        with self.lock:
+            self.statements += 1
+            self.rows += len(params.get("rows") or params.get("keys") or [])
+            if keep:
+                self.queries.append((query, params))
+
+class FakeTransaction:
+    def __init__(self, driver):
+        self.driver = driver
+
+    def run(self, query, parameters=None, **kwargs):
+        return self.driver.execute(query, {**(parameters or {}), **kwargs})
+
+class FakeSession(FakeTransaction):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def close(self):
+        pass
+
+    def execute_write(self, transaction_function, *args, **kwargs):
+        return transaction_function(FakeTransaction(self.driver), *args, **kwargs)
+
+    execute_read = execute_write
+
+class FakeDriver:
+    """Stand-in for the neo4j driver that records the statements it receives.
+    responder(query, params) returns the records of each statement (none by default)
+    and latency simulates the round trip to the database, in seconds"""
+
+    def __init__(self, responder=None, latency=0.0, keep_queries=False):
+        self.responder = responder
+        self.latency = latency
+        self.keep_queries = keep_queries
+        self.recorder = Recorder()
+
+    def execute(self, query, params):
+        self.recorder.record(query, params, self.keep_queries)
+        if self.latency:
+            time.sleep(self.latency)
+        return FakeResult(self.responder(query, params) if self.responder else [])
+
+    def session(self, **kwargs):
+        return FakeSession(self)
+
+    def verify_connectivity(self):
+        return None
+
+    def close(self):
+        pass
+
+class FakeEmbeddings(Embeddings):
+    """Deterministic embedder: the vector of a text is seeded by its md5, so the same
+    text always gets the same normalized vector. cost simulates the encoding time
+    of each text, in seconds"""
+
+    def __init__(self, dimension=384, cost=0.0):
+        self.dimension = dimension
+        self.cost = cost
+
+    def vector(self, text):
+        seed = int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16)
+        vector = np.random.default_rng(seed).standard_normal(self.dimension).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts):
+        if self.cost:
+            time.sleep(self.cost * len(texts))
+        return [self.vector(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+class FakeStreamingChatModel(SimpleChatModel):
+    """Chat model that streams a fixed answer word by word to the callbacks,
+    waiting first_token_delay before the first word and token_delay after each one"""
+
+    answer: str = "Según el contrato, la duración es de un año prorrogable por periodos iguales."
+    first_token_delay: float = 0.0
+    token_delay: float = 0.0
+    model_name: str = 'gpt-3.5-turbo'
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-streaming-chat"
+
+    def _call(self, messages: List[Any], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> str:
+        time.sleep(self.first_token_delay)
+        for token in re.findall(r'\s*\S+', self.answer):
+            if run_manager:
+                run_manager.on_llm_new_token(token)
+            if self.token_delay:
+                time.sleep(self.token_delay)
+        return self.answer
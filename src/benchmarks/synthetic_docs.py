@@ -0,0 +1,51 @@
+import random
+
+# Frases de contrato usadas para generar el texto de los documentos sintéticos
+CLAUSES = ["El arrendatario abonará la renta mensual de {n} euros dentro de los cinco primeros días de cada mes.",
+           "Cualquiera de las partes podrá resolver el contrato con un preaviso de {n} días.",
+           "La duración del contrato será de {n} meses, prorrogable tácitamente por periodos iguales.",
+           "La póliza número {n} cubre los daños materiales del inmueble asegurado.",
+           "Las retenciones del IRPF se practicarán conforme al artículo {n} de la ley.",
+           "El proveedor garantiza la confidencialidad de la información facilitada durante {n} años.",
+           "Las partes se someten a los juzgados y tribunales de la ciudad de Madrid."]
+TITLES = ["Objeto del contrato", "Duración", "Precio y forma de pago", "Obligaciones de las partes",
+          "Resolución", "Confidencialidad", "Seguros", "Jurisdicción"]
+BLOCKS_PER_PAGE = 12
+
+def synthetic_blocks(sections=8, subsections=2, chunks=4, tables=1, sentences=3, seed=0):
+    """Function that generates the blocks json of a layout document as returned by llmsherpa:
+    top level sections with subsections, each with chunks of sentences and tables"""
+
+    rng = random.Random(seed)
+    blocks = []
+
+    def add(block):
+        block["block_idx"] = len(blocks)
+        block["page_idx"] = len(blocks) // BLOCKS_PER_PAGE
+        block["bbox"] = [0, 0, 0, 0]
+        blocks.append(block)
+
+    def add_content(level, prefix):
+        for _ in range(chunks):
+            add({"tag": "para", "level": level,
+                 "sentences": [rng.choice(CLAUSES).format(n=rng.randint(1, 999)) for _ in range(sentences)]})
+        for t in range(tables):
+            rows = [{"type": "table_header", "cells": [{"cell_value": "Concepto"}, {"cell_value": "Importe"}]}]
+            rows += [{"type": "table_data_row", "cells": [{"cell_value": f"Concepto {r}"}, {"cell_value": str(rng.randint(1, 9999))}]}
+                     for r in range(4)]
+            add({"tag": "table", "level": level, "name": f"Tabla {prefix}.{t + 1}", "sentences": [], "table_rows": rows})
+
+    for s in range(sections):
+        add({"tag": "header", "level": 0, "sentences": [f"{s + 1}. {TITLES[s % len(TITLES)]}"]})
+        add_content(1, f"{s + 1}")
+        for sub in range(subsections):
+            add({"tag": "header", "level": 1, "sentences": [f"{s + 1}.{sub + 1}. {TITLES[(s + sub + 1) % len(TITLES)]}"]})
+            add_content(2, f"{s + 1}.{sub + 1}")
+    return blocks
+
+def synthetic_document(**kwargs):
+    """Function that returns a synthetic llmsherpa Document, built from
+    synthetic_blocks like the documents rebuilt from the parse cache"""
+
+    from llmsherpa.readers import Document
+    return Document(synthetic_blocks(**kwargs))
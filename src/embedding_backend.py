@@ -0,0 +1,172 @@
+import argparse
+import os
+import time
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+DEFAULT_MODEL = 'sentence-transformers/all-MiniLM-L6-v2'
+# torch: el modelo de SentenceTransformer en fp32, int8: las capas Linear cuantizadas
+# dinámicamente a int8, onnx: el modelo exportado a ONNX y ejecutado con onnxruntime
+ENGINES = ('torch', 'int8', 'onnx')
+# Carpeta donde se guardan los modelos exportados a ONNX
+ONNX_LOCATION = os.path.join(os.path.dirname(__file__), 'cache', 'onnx')
+BATCH_SIZE = 128
+
+def get_device():
+    # torch solo se importa cuando se carga el modelo, no al importar el módulo
+    import torch.cuda as cuda
+    return f'cuda:{cuda.current_device()}' if cuda.is_available() else 'cpu'
+
+class EmbeddingBackend(Embeddings):
+    """Embedding model shared by the ingestion and the streamlit application,
+    with the engine selected by name. The model is loaded on the first call.
+    The int8 and onnx engines run on CPU and return vectors close to the torch
+    ones (see parity_check); cache_id keeps their vectors apart in the embedding cache.
+    threads limits the CPU threads used by torch or onnxruntime in the process"""
+
+    def __init__(self, model_id=DEFAULT_MODEL, engine='torch', device=None, batch_size=BATCH_SIZE, threads=None):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown embedding engine {engine}, expected one of {', '.join(ENGINES)}")
+        self.model_id = model_id
+        self.engine = engine
+        self.device = device
+        self.batch_size = batch_size
+        self.threads = threads
+        self.model = None
+        self.tokenizer = None
+
+    @property
+    def cache_id(self):
+        return self.model_id if self.engine == 'torch' else f'{self.model_id}#{self.engine}'
+
+    def load(self):
+        if self.model is not None:
+            return
+        if self.engine == 'onnx':
+            self.load_onnx()
+            return
+
+        from sentence_transformers import SentenceTransformer
+        if self.threads:
+            import torch
+            torch.set_num_threads(self.threads)
+        if self.engine == 'int8':
+            import torch
+            model = SentenceTransformer(self.model_id, device='cpu')
+            self.model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        else:
+            self.model = SentenceTransformer(self.model_id, device=self.device or get_device())
+
+    def load_onnx(self):
+        try:
+            from optimum.onnxruntime import ORTModelForFeatureExtraction
+            from transformers import AutoTokenizer
+        except ImportError:
+            raise ImportError("The onnx embedding engine needs optimum and onnxruntime: pip install optimum[onnxruntime]")
+
+        session_options = None
+        if self.threads:
+            import onnxruntime
+            session_options = onnxruntime.SessionOptions()
+            session_options.intra_op_num_threads = self.threads
+            session_options.inter_op_num_threads = 1
+
+        # El modelo se exporta a ONNX la primera vez y se reutiliza en las siguientes cargas
+        location = os.path.join(ONNX_LOCATION, self.model_id.replace('/', '--'))
+        if os.path.exists(os.path.join(location, 'model.onnx')):
+            self.model = ORTModelForFeatureExtraction.from_pretrained(location, session_options=session_options)
+            self.tokenizer = AutoTokenizer.from_pretrained(location)
+        else:
+            self.model = ORTModelForFeatureExtraction.from_pretrained(self.model_id, export=True, session_options=session_options)
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model_id)
+            self.model.save_pretrained(location)
+            self.tokenizer.save_pretrained(location)
+
+    def encode_onnx(self, texts):
+        # Mean pooling y normalización L2, como los módulos Pooling y Normalize de all-MiniLM-L6-v2
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            inputs = self.tokenizer(texts[start:start + self.batch_size], padding=True, truncation=True,
+                                    max_length=256, return_tensors='np')
+            hidden = self.model(**inputs).last_hidden_state
+            hidden = hidden.numpy() if hasattr(hidden, 'numpy') else np.asarray(hidden)
+            mask = inputs['attention_mask'][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            vectors.append(pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None))
+        return np.concatenate(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+
+    def encode(self, texts):
+        self.load()
+        texts = [text.replace("\n", " ") for text in texts]
+        if self.engine == 'onnx':
+            return self.encode_onnx(texts)
+        return self.model.encode(texts, batch_size=self.batch_size, convert_to_numpy=True, show_progress_bar=False)
+
+    def embed_documents(self, texts):
+        return self.encode(list(texts)).tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+def parity_check(backend, texts, reference=None):
+    """Function that compares the vectors of an engine with the fp32 torch vectors
+    of the same texts. Returns the minimum and mean cosine similarity and the
+    maximum absolute difference"""
+
+    reference = reference or EmbeddingBackend(backend.model_id, 'torch', device='cpu')
+    expected = np.asarray(reference.embed_documents(texts), dtype=np.float32)
+    vectors = np.asarray(backend.embed_documents(texts), dtype=np.float32)
+    cosine = (expected * vectors).sum(axis=1) / (np.linalg.norm(expected, axis=1) * np.linalg.norm(vectors, axis=1))
+    return {"min_cosine": float(cosine.min()),
+            "mean_cosine": float(cosine.mean()),
+            "max_abs_diff": float(np.abs(expected - vectors).max())}
+
+def benchmark(backend, texts, repeat=3):
+    """Function that measures the texts encoded per second by an engine.
+    The first call loads the model and is not measured"""
+
+    backend.embed_documents(texts[:1])
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        backend.embed_documents(texts)
+        elapsed.append(time.perf_counter() - start)
+    return {"texts_per_s": len(texts) / min(elapsed), "batch_s": min(elapsed)}
+
+def sample_texts(n):
+    # Frases sintéticas con la longitud de los chunks de los contratos
+    clauses = ["El arrendatario abonará la renta mensual dentro de los cinco primeros días de cada mes.",
+               "Cualquiera de las partes podrá resolver el contrato con un preaviso de treinta días.",
+               "La duración del contrato será de un año, prorrogable tácitamente por periodos iguales.",
+               "Las partes se someten a los juzgados y tribunales de la ciudad de Madrid.",
+               "El proveedor garantiza la confidencialidad de la información facilitada por el cliente."]
+    return [f"{clauses[i % len(clauses)]} Cláusula {i}." for i in range(n)]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Parity check and throughput of the embedding engines')
+    parser.add_argument('--engines', nargs='+', choices=ENGINES, default=list(ENGINES))
+    parser.add_argument('--model', default=DEFAULT_MODEL)
+    parser.add_argument('--texts', type=int, default=512, help='number of synthetic texts')
+    parser.add_argument('--texts-file', help='file with one text per line, instead of the synthetic texts')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--threads', type=int, help='CPU threads of each engine, by default all the cores')
+    args = parser.parse_args()
+
+    if args.texts_file:
+        with open(args.texts_file, encoding='utf-8') as f:
+            texts = [line.strip() for line in f if line.strip()]
+    else:
+        texts = sample_texts(args.texts)
+
+    reference = EmbeddingBackend(args.model, 'torch', device='cpu', batch_size=args.batch_size, threads=args.threads)
+    for engine in args.engines:
+        backend = reference if engine == 'torch' else EmbeddingBackend(args.model, engine, batch_size=args.batch_size,
+                                                                       threads=args.threads)
+        try:
+            speed = benchmark(backend, texts)
+            parity = parity_check(backend, texts[:64], reference)
+        except ImportError as e:
+            print(f'{engine}: {e}')
+            continue
+        print(f"{engine}: {speed['texts_per_s']:.1f} texts/s, min cosine {parity['min_cosine']:.4f}, "
+              f"mean cosine {parity['mean_cosine']:.4f}, max abs diff {parity['max_abs_diff']:.4f}")
@@ -0,0 +1,108 @@
+import queue
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+import numpy as np
+from langchain_core.embeddings import Embeddings
+import instrumentation
+
+# Segundos que el worker espera a más textos después de recibir el primero de un lote
+BATCH_WINDOW = 0.005
+# Número máximo de textos codificados en una sola pasada del modelo
+MAX_BATCH = 32
+# Número de esperas recientes usadas para los percentiles de las métricas
+WAIT_SAMPLES = 1000
+
+class BatchMetrics:
+    """Batch size and queue wait statistics of a BatchingEmbeddings worker"""
+
+    def __init__(self, samples=WAIT_SAMPLES):
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.texts = 0
+        self.batch_sizes = Counter()
+        self.waits = deque(maxlen=samples)
+
+    def record(self, size, waits):
+        with self.lock:
+            self.batches += 1
+            self.texts += size
+            self.batch_sizes[size] += 1
+            self.waits.extend(waits)
+
+    def snapshot(self):
+        with self.lock:
+            waits = np.array(self.waits) * 1000 if self.waits else np.zeros(1)
+            return {"batches": self.batches,
+                    "texts": self.texts,
+                    "mean_batch_size": self.texts / self.batches if self.batches else 0.0,
+                    "batch_sizes": dict(sorted(self.batch_sizes.items())),
+                    "queue_wait_ms_p50": float(np.percentile(waits, 50)),
+                    "queue_wait_ms_p95": float(np.percentile(waits, 95)),
+                    "queue_wait_ms_max": float(waits.max())}
+
+class BatchingEmbeddings(Embeddings):
+    """Embeddings wrapper that groups the texts of concurrent calls in one batched
+    encode of the wrapped model. A background worker takes every text queued while
+    the model was busy plus the ones arriving in the next window seconds, up to
+    max_batch texts, and hands each vector back to the thread waiting for it.
+    Calls with max_batch texts or more are encoded directly"""
+
+    def __init__(self, embeddings, window=BATCH_WINDOW, max_batch=MAX_BATCH):
+        self.embeddings = embeddings
+        self.window = window
+        self.max_batch = max_batch
+        self.metrics = BatchMetrics()
+        self.requests = queue.Queue()
+        self.worker = None
+        self.lock = threading.Lock()
+
+    def submit(self, text):
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.run, daemon=True)
+                self.worker.start()
+        future = Future()
+        self.requests.put((text, future, time.monotonic()))
+        return future
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.window
+        try:
+            while len(batch) < self.max_batch:
+                batch.append(self.requests.get_nowait())
+        except queue.Empty:
+            pass
+        try:
+            while len(batch) < self.max_batch:
+                batch.append(self.requests.get(timeout=max(deadline - time.monotonic(), 0)))
+        except queue.Empty:
+            pass
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            started = time.monotonic()
+            try:
+                with instrumentation.span('embedding_batch'):
+                    vectors = self.embeddings.embed_documents([text for text, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+            else:
+                for (_, future, _), vector in zip(batch, vectors):
+                    future.set_result(vector)
+            self.metrics.record(len(batch), [started - queued for _, _, queued in batch])
+            instrumentation.count('embedding_texts', len(batch))
+
+    def embed_documents(self, texts):
+        if len(texts) >= self.max_batch:
+            return self.embeddings.embed_documents(texts)
+        futures = [self.submit(text) for text in texts]
+        return [future.result() for future in futures]
+
+    def embed_query(self, text):
+        return self.submit(text).result()
@@ -0,0 +1,121 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# Fichero local de la caché compartida por la ingesta y la aplicación de streamlit
+CACHE_PATH = os.path.join(os.path.dirname(__file__), 'cache', 'embeddings.sqlite')
+# Número máximo de vectores guardados antes de eliminar los menos usados
+MAX_ENTRIES = 500000
+# Segundos que una conexión espera a que otra libere el fichero antes de fallar con "database is locked";
+# los procesos del modo paralelo de la ingesta comparten la caché
+BUSY_TIMEOUT = 30.0
+
+_shared_cache = None
+_shared_lock = threading.Lock()
+
+def text_hash(text):
+    return hashlib.md5(text.encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    """Persistent embedding cache keyed by (model id, text hash).
+    The vectors are stored as float32 blobs in a SQLite file and the least
+    recently used entries are evicted when the cache grows over max_entries"""
+
+    def __init__(self, path=CACHE_PATH, max_entries=MAX_ENTRIES):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+            model_id TEXT NOT NULL,
+            text_hash TEXT NOT NULL,
+            vector BLOB NOT NULL,
+            last_used REAL NOT NULL,
+            PRIMARY KEY (model_id, text_hash))""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.conn.commit()
+
+    def get_many(self, model_id, hashes):
+        """Returns a dict with the cached vectors of the given text hashes"""
+
+        found = {}
+        with self.lock:
+            for start in range(0, len(hashes), 500):
+                part = hashes[start:start + 500]
+                placeholders = ','.join('?' * len(part))
+                cursor = self.conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model_id = ? AND text_hash IN ({placeholders})",
+                    [model_id, *part])
+                for hash_val, blob in cursor:
+                    found[hash_val] = np.frombuffer(blob, dtype=np.float32).tolist()
+            if found:
+                now = time.time()
+                self.conn.executemany("UPDATE embeddings SET last_used = ? WHERE model_id = ? AND text_hash = ?",
+                                      [(now, model_id, hash_val) for hash_val in found])
+                self.conn.commit()
+        return found
+
+    def put_many(self, model_id, vectors):
+        """Stores a dict of text hash -> vector and evicts the least recently used
+        entries when the cache is over max_entries"""
+
+        now = time.time()
+        with self.lock:
+            changes = self.conn.total_changes
+            self.conn.executemany("INSERT OR IGNORE INTO embeddings VALUES (?, ?, ?, ?)",
+                                  [(model_id, hash_val, np.asarray(vector, dtype=np.float32).tobytes(), now)
+                                   for hash_val, vector in vectors.items()])
+            # El tamaño se lee del fichero y no de un contador del proceso, porque los procesos del modo
+            # paralelo de la ingesta y la aplicación escriben en la misma caché
+            if self.conn.total_changes > changes:
+                size = self.conn.execute("SELECT count(*) FROM embeddings").fetchone()[0]
+                if size > self.max_entries:
+                    # Se libera un 10% extra para no tener que evictar en cada escritura
+                    excess = size - int(self.max_entries * 0.9)
+                    self.conn.execute("DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+                                      (excess,))
+            self.conn.commit()
+
+def get_cache():
+    """Function that returns the embedding cache shared by the whole process"""
+
+    global _shared_cache
+    with _shared_lock:
+        if _shared_cache is None:
+            _shared_cache = EmbeddingCache()
+    return _shared_cache
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that looks up every text in the embedding cache
+    before calling the wrapped model, which only encodes the missing texts.
+    The key is the md5 of the text that is actually embedded"""
+
+    def __init__(self, embeddings, model_id, cache=None):
+        self.embeddings = embeddings
+        self.model_id = model_id
+        self.cache = cache or get_cache()
+
+    def embed_documents(self, texts):
+        hashes = [text_hash(text) for text in texts]
+        found = self.cache.get_many(self.model_id, list(set(hashes)))
+
+        missing = {}
+        for hash_val, text in zip(hashes, texts):
+            if hash_val not in found:
+                missing[hash_val] = text
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            new_vectors = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(self.model_id, new_vectors)
+            found.update(new_vectors)
+
+        return [found[hash_val] for hash_val in hashes]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
@@ -0,0 +1,300 @@
+import atexit
+import bisect
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append('/Users/nfanlo/dev')
+from config.config import config
+
+# Upper bounds in seconds of the histogram buckets, as in the Prometheus client defaults plus longer ones for the llm
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Recent observations of each histogram kept to compute its percentiles
+SAMPLES = 1000
+# Prefix of the metric names in the Prometheus text format
+PREFIX = 'tfm_'
+
+# Exporters enabled in config.py: a comma separated list of log, prometheus and json. Empty disables the instrumentation
+EXPORTERS = config.get('instrumentation', '')
+PROMETHEUS_PORT = config.get('instrumentation_port', 9464)
+JSON_PATH = config.get('instrumentation_path', os.path.join(os.path.dirname(__file__), 'cache', 'metrics.json'))
+JSON_INTERVAL = 10 #Seconds between two snapshots written by the json exporter
+
+logger = logging.getLogger('tfm.instrumentation')
+
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+class Histogram:
+    """Counts of the observations in each bucket, their sum and the last
+    SAMPLES observations, used for the p50, p95 and p99 of the snapshot"""
+
+    def __init__(self, buckets=BUCKETS, samples=SAMPLES):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+        self.samples = deque(maxlen=samples)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+        self.samples.append(value)
+
+    def percentile(self, q):
+        samples = sorted(self.samples)
+        return samples[min(int(q * len(samples)), len(samples) - 1)] if samples else 0.0
+
+    def snapshot(self):
+        return {"count": self.count,
+                "sum": self.sum,
+                "mean": self.sum / self.count if self.count else 0.0,
+                "p50": self.percentile(0.50),
+                "p95": self.percentile(0.95),
+                "p99": self.percentile(0.99),
+                "max": self.max}
+
+class Registry:
+    """Counters and histograms of the process, keyed by name and labels"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name, value, labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def snapshot(self):
+        """Returns the counters and the histogram statistics as a json serializable dict"""
+
+        with self.lock:
+            return {"counters": [{"name": name, "labels": dict(labels), "value": value}
+                                 for (name, labels), value in sorted(self.counters.items())],
+                    "histograms": [{"name": name, "labels": dict(labels), **histogram.snapshot()}
+                                   for (name, labels), histogram in sorted(self.histograms.items())]}
+
+    def prometheus_text(self):
+        """Returns the counters and histograms in the Prometheus text exposition format"""
+
+        def format_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f'# TYPE {PREFIX}{name}_total counter')
+                for (counter, labels), value in sorted(self.counters.items()):
+                    if counter == name:
+                        lines.append(f'{PREFIX}{name}_total{format_labels(labels)} {value}')
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f'# TYPE {PREFIX}{name} histogram')
+                for (histogram_name, labels), histogram in sorted(self.histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                        cumulative += count
+                        lines.append(f'{PREFIX}{name}_bucket{format_labels(labels, [("le", bound)])} {cumulative}')
+                    lines.append(f'{PREFIX}{name}_sum{format_labels(labels)} {histogram.sum}')
+                    lines.append(f'{PREFIX}{name}_count{format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+class LogExporter:
+    """Writes one log line per span with its duration and labels"""
+
+    def __init__(self):
+        if not logger.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+
+    def on_span(self, name, seconds, labels):
+        logger.info('span=%s duration_ms=%.1f %s', name, seconds * 1000,
+                    ' '.join(f'{label}={value}' for label, value in labels.items()))
+
+    def close(self):
+        pass
+
+class PrometheusExporter:
+    """Serves the registry in the Prometheus text format on GET /metrics
+    from a background HTTP server started with the first span"""
+
+    def __init__(self, registry, port=PROMETHEUS_PORT):
+        self.registry = registry
+        self.port = port
+        self.server = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        with self.lock:
+            if self.server is not None:
+                return
+            try:
+                self.server = ThreadingHTTPServer(('0.0.0.0', self.port), Handler)
+            except OSError as e:
+                # Another process of the host (another streamlit worker) already serves the port
+                logger.info('Prometheus endpoint not started on port %s: %s', self.port, e)
+                self.server = False
+                return
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def on_span(self, name, seconds, labels):
+        if self.server is None:
+            self.start()
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+
+class JsonExporter:
+    """Writes a snapshot of the registry to a json file every interval
+    seconds from a background thread, and once more when the process exits"""
+
+    def __init__(self, registry, path=JSON_PATH, interval=JSON_INTERVAL):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.writer = None
+        self.lock = threading.Lock()
+
+    def write(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"time": time.time(), "pid": os.getpid(), **self.registry.snapshot()}, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.write()
+
+    def on_span(self, name, seconds, labels):
+        with self.lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.run, daemon=True)
+                self.writer.start()
+
+    def close(self):
+        if self.writer is not None:
+            self.write()
+
+registry = Registry()
+exporters = []
+enabled = False
+
+class Span:
+    """Context manager that measures the duration of a stage. The duration is
+    always available in elapsed (the loaders print it), but it is only recorded
+    in the histogram {name}_seconds and sent to the exporters when enabled"""
+
+    __slots__ = ('name', 'labels', 'start', 'elapsed')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.elapsed = time.perf_counter() - self.start
+        if enabled:
+            if exc_type is not None:
+                self.labels["error"] = exc_type.__name__
+            record_span(self.name, self.elapsed, self.labels)
+        return False
+
+def span(name, **labels):
+    """Returns a Span of the stage name with the given labels"""
+
+    return Span(name, labels)
+
+def record_span(name, seconds, labels):
+    registry.observe(name + '_seconds', seconds, labels)
+    for exporter in exporters:
+        exporter.on_span(name, seconds, labels)
+
+def observe(name, seconds, **labels):
+    """Records a duration measured by the caller, such as the time to the first
+    token of the llm, which does not start and end in the same block"""
+
+    if enabled:
+        record_span(name, seconds, labels)
+
+def count(name, value=1, **labels):
+    if enabled:
+        registry.count(name, value, labels)
+
+def snapshot():
+    return registry.snapshot()
+
+def prometheus_text():
+    return registry.prometheus_text()
+
+def configure(names=EXPORTERS, port=PROMETHEUS_PORT, path=JSON_PATH):
+    """Function that enables the instrumentation with the exporters given as a
+    comma separated string (log, prometheus, json) or disables it when empty"""
+
+    global enabled
+    for exporter in exporters:
+        exporter.close()
+    exporters.clear()
+    names = [name.strip() for name in (names or '').split(',') if name.strip()]
+    for name in names:
+        if name == 'log':
+            exporters.append(LogExporter())
+        elif name == 'prometheus':
+            exporters.append(PrometheusExporter(registry, port))
+        elif name == 'json':
+            exporters.append(JsonExporter(registry, path))
+        else:
+            raise ValueError(f'Unknown instrumentation exporter: {name}')
+    enabled = bool(names)
+
+@atexit.register
+def close_exporters():
+    for exporter in exporters:
+        exporter.close()
+
+configure()
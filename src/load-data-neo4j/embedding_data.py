@@ -1,38 +1,68 @@
+import argparse
 import sys
 import os
+import glob
 import json
-from datetime import datetime
-from neo4j import GraphDatabase
-import torch.cuda as cuda
-from langchain.embeddings.huggingface import HuggingFaceEmbeddings
+import multiprocessing
+import random
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from neo4j.exceptions import ServiceUnavailable, SessionExpired, TransientError
 
 # Añadir la ruta para importar configuraciones
 sys.path.append('/Users/nfanlo/dev')
 from config.config import config
 
+# Añadir la ruta de los módulos compartidos con la aplicación de streamlit
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from embedding_cache import CachedEmbeddings
+from embedding_backend import EmbeddingBackend
+from neo4j_driver import get_driver, check_vector_index
+import instrumentation
+
 # Configuración de Neo4j
 NEO4J_USER = "neo4j"
 NEO4J_DATABASE = "neo4j"
 NEO4J_PASSWORD = config["neo4j_password"]
 NEO4J_URL = config["neo4j_url"]
 
-# Selección del modelo para embedding
+# Selección del modelo para embedding y del motor que lo ejecuta: torch, int8 u onnx
 embed_model_id = 'sentence-transformers/all-MiniLM-L6-v2'
+embed_engine = config.get('embedding_engine', 'torch')
+
+# Número de nodos leídos, codificados y escritos en cada página del modo por lotes
+PAGE_SIZE = 512
+
+# Carpeta de los checkpoints del modo por lotes, un fichero por nodo y propiedad
+CHECKPOINT_LOCATION = os.path.join(os.path.dirname(__file__), 'checkpoints')
 
-# Configuración del dispositivo
-device = f'cuda:{cuda.current_device()}' if cuda.is_available() else 'cpu'
+# Reintentos de cada lectura o escritura ante errores transitorios de Neo4j o bloqueos de la caché de embeddings,
+# con una espera que se duplica en cada intento desde RETRY_DELAY hasta MAX_RETRY_DELAY segundos
+MAX_RETRIES = 6
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+TRANSIENT_ERRORS = (ServiceUnavailable, SessionExpired, TransientError, ConnectionError)
 
-def embedding_model():
-    return HuggingFaceEmbeddings(model_name=embed_model_id,
-        model_kwargs={'device': device},
-        encode_kwargs={'device': device, 'batch_size': 128})
+# Procesos del modo paralelo; los núcleos de la máquina se reparten entre ellos
+WORKERS = 4
+
+def embedding_model(threads=None):
+    # Los textos ya codificados se leen de la caché local de embeddings
+    backend = EmbeddingBackend(embed_model_id, embed_engine, batch_size=128, threads=threads)
+    return CachedEmbeddings(backend, backend.cache_id)
+
+def embedding_dimension():
+    # El vector de la consulta se lee de la caché de embeddings si ya se codificó antes
+    return len(embedding_model().embed_query('dimension'))
 
 def create_embedding(node, property):
     """Function to create embeddings from chunks of the Neo4j database.
     The function expects a tuple with the name of the node and the name of 
     the property to apply the selected embedding"""
 
-    driver = GraphDatabase.driver(NEO4J_URL, auth=(NEO4J_USER, NEO4J_PASSWORD), database=NEO4J_DATABASE)
+    driver = get_driver()
     embed_model = embedding_model()
 
     with driver.session() as session:
@@ -48,15 +78,16 @@ def create_embedding(node, property):
             for result in results:
                 id = result["id"]
                 text = result["text"]
-                embedding = embed_model.embed_documents([text])  # Cambié esta línea
-                embedding_str = json.dumps(embedding[0])  # Convertir el primer resultado a JSON
+                with instrumentation.span('embedding_encode', node=node):
+                    embedding = embed_model.embed_documents([text])  # Cambié esta línea
 
-                # Embedding: Crear nodo de Embedding con 'key' y 'embedding'
+                # Embedding: Crear nodo de Embedding con 'key' y 'embedding', o actualizar el que ya exista
                 # Relación id-Embedding: Crear relación [:HAS_EMBEDDING] desde id a nodo Embedding
-                cypher = "CREATE (e:Embedding) SET e.key=$key, e.value=$embedding"
-                cypher = cypher + " WITH e MATCH (n) WHERE id(n) = $id CREATE (n) -[:HAS_EMBEDDING]-> (e)"
-                cypher = cypher + " SET n.embedding_created = true"
-                session.run(cypher, key=property, embedding=embedding_str, id=id)
+                cypher = "MATCH (n) WHERE id(n) = $id MERGE (n) -[:HAS_EMBEDDING]-> (e:Embedding {key: $key})"
+                cypher = cypher + " SET e.value = $embedding, n.embedding_created = true"
+                with instrumentation.span('embedding_write', node=node):
+                    session.run(cypher, key=property, embedding=embedding[0], id=id)
+                instrumentation.count('embedding_nodes', node=node)
 
                 count += 1
                 
@@ -75,15 +106,294 @@ def create_embedding(node, property):
         finally:
             session.close()
 
+# Escritura idempotente: un lote reintentado actualiza el nodo Embedding existente en lugar de crear otro
+write_embeddings_cypher = """
+    UNWIND $rows AS row
+    MATCH (n) WHERE id(n) = row.id
+    MERGE (n) -[:HAS_EMBEDDING]-> (e:Embedding {key: $key})
+    SET e.value = row.embedding, n.embedding_created = true
+"""
+
+def is_transient(error):
+    """Function that tells if an error may not happen again: the transient errors of
+    Neo4j and the locks of the embedding cache, shared by the processes of the parallel mode"""
+
+    if isinstance(error, sqlite3.OperationalError):
+        return 'locked' in str(error) or 'busy' in str(error)
+    return isinstance(error, TRANSIENT_ERRORS)
+
+def retry(function, retries=MAX_RETRIES, delay=RETRY_DELAY, max_delay=MAX_RETRY_DELAY):
+    """Function that calls function again after each transient error of Neo4j or lock
+    of the embedding cache, waiting an exponentially growing time with jitter between
+    the attempts. Other errors, and the last transient one, are raised"""
+
+    for attempt in range(retries + 1):
+        try:
+            return function()
+        except Exception as e:
+            if attempt == retries or not is_transient(e):
+                raise
+            wait = min(max_delay, delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+            print(f'TRANSIENT ERROR: {e} ||| RETRY {attempt + 1}/{retries} IN {wait:.1f}s')
+            instrumentation.count('embedding_retries')
+            time.sleep(wait)
+
+class Checkpoint:
+    """Cursor of an embedding job saved in a json file: the id of the last node
+    written and the number of nodes processed. It is saved after each page is
+    committed, so a failed run resumes after the last written page, and removed
+    when the job finishes, so the next run looks at every node again.
+    Without path nothing is written to disk"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.last_id = -1
+        self.processed = 0
+        if path and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.last_id = state["last_id"]
+            self.processed = state["processed"]
+
+    def save(self, last_id, processed):
+        self.last_id = last_id
+        self.processed = processed
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({"last_id": last_id, "processed": processed, "updated_at": time.time()}, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+def checkpoint_path(node, property, shard=0, shards=1):
+    # Cada shard del modo paralelo guarda su propio cursor
+    suffix = f'-{shard}of{shards}' if shards > 1 else ''
+    return os.path.join(CHECKPOINT_LOCATION, f'{node}-{property}{suffix}.json')
+
+def progress(count, total, resumed, start, node, property, shard_label=''):
+    # Velocidad medida solo con los nodos de esta ejecución, sin los del checkpoint
+    rate = (count - resumed) / max(time.monotonic() - start, 1e-9)
+    eta = timedelta(seconds=int((total - count) / rate)) if rate else '-'
+    print(f'Processed {str(count)}/{str(total)} ||| Node: {node} ||| Property: {property}{shard_label} ||| {rate:.1f} nodes/s ||| ETA: {eta}')
+
+def create_embedding_batched(node, property, embed_model=None, page_size=PAGE_SIZE, driver=None,
+                             checkpoint=True, retries=MAX_RETRIES, shard=0, shards=1, raise_errors=False):
+    """Function to create embeddings from chunks of the Neo4j database in pages.
+    Each page of nodes without embeddings is encoded as one batch and written back 
+    with a single UNWIND statement. The same embedding model is used for the whole run. 
+    A driver can be passed, otherwise the shared driver of the process is used. 
+    The reads and writes of each page are retried on transient errors and the writes 
+    are idempotent. With checkpoint the id of the last written node is saved in 
+    CHECKPOINT_LOCATION, so an interrupted run resumes after the last written page. 
+    With shards > 1 only the nodes whose id modulo shards equals shard are processed.
+    An error stops the run and is printed, and also raised with raise_errors"""
+
+    if driver is None:
+        driver = get_driver()
+    if embed_model is None:
+        embed_model = embedding_model()
+
+    # Paginación por id para no volver a leer nodos ya procesados
+    pending_cypher = f"""
+        MATCH (chunk:{node}) -[:HAS_PARENT]-> (s:Section)
+        WHERE (chunk.embedding_created IS NULL OR chunk.embedding_created = false) AND id(chunk) > $last_id
+          AND id(chunk) % $shards = $shard
+        RETURN count(chunk) AS total
+    """
+    read_cypher = f"""
+        MATCH (chunk:{node}) -[:HAS_PARENT]-> (s:Section)
+        WHERE (chunk.embedding_created IS NULL OR chunk.embedding_created = false) AND id(chunk) > $last_id
+          AND id(chunk) % $shards = $shard
+        RETURN id(chunk) AS id, s.title + ' >> ' + chunk.{property} AS text
+        ORDER BY id ASC LIMIT $page_size
+    """
+
+    def read(cypher, **params):
+        with driver.session() as session:
+            return session.execute_read(lambda tx: tx.run(cypher, **params).data())
+
+    def write(rows):
+        with driver.session() as session:
+            session.execute_write(lambda tx: tx.run(write_embeddings_cypher, rows=rows, key=property).consume())
+
+    shard_label = f' ||| Shard: {shard + 1}/{shards}' if shards > 1 else ''
+    cursor = Checkpoint(checkpoint_path(node, property, shard, shards) if checkpoint else None)
+    if cursor.last_id >= 0:
+        print(f'RESUMING FROM CHECKPOINT ||| Node: {node}{shard_label} ||| Last id: {cursor.last_id} ||| Processed: {cursor.processed}')
+    resumed = count = cursor.processed
+    try:
+        pending = retry(lambda: read(pending_cypher, last_id=cursor.last_id, shard=shard, shards=shards), retries)
+        total = count + (pending[0]["total"] if pending else 0)
+        start = time.monotonic()
+        while True:
+            with instrumentation.span('embedding_read', node=node):
+                page = retry(lambda: read(read_cypher, last_id=cursor.last_id, page_size=page_size,
+                                         shard=shard, shards=shards), retries)
+            if not page:
+                break
+
+            with instrumentation.span('embedding_encode', node=node):
+                embeddings = retry(lambda: embed_model.embed_documents([row["text"] for row in page]), retries)
+            rows = [{"id": row["id"], "embedding": embedding} for row, embedding in zip(page, embeddings)]
+            with instrumentation.span('embedding_write', node=node):
+                retry(lambda: write(rows), retries)
+            instrumentation.count('embedding_nodes', len(page), node=node)
+
+            count += len(page)
+            cursor.save(page[-1]["id"], count)
+            progress(count, total, resumed, start, node, property, shard_label)
+
+        cursor.clear()
+        print('-----------------------------------------------------------------')
+        return count
+
+    except Exception as e:
+        print('-----------------------------------------------------------------')
+        print(f"CONECTION ERROR: {e}")
+        if checkpoint:
+            print(f'RUN AGAIN TO RESUME AFTER NODE {cursor.last_id} ({cursor.processed} NODES DONE)')
+        if raise_errors:
+            # Las excepciones del driver no siempre se pueden enviar al proceso principal
+            raise RuntimeError(f'{type(e).__name__}: {e}') from None
+        return count
+
+# Modelo de embedding de cada proceso del modo paralelo, cargado una sola vez por init_worker
+worker_model = None
+
+def init_worker(threads):
+    """Initializer of the processes of the parallel mode. It limits the threads of
+    torch, onnxruntime and the BLAS libraries, so the workers do not compete for
+    the same cores, and loads the embedding model once per process"""
+
+    global worker_model
+    for variable in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        os.environ[variable] = str(threads)
+    os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+    worker_model = embedding_model(threads)
+    worker_model.embeddings.load()
+
+def embed_shard(node, property, shard, shards, page_size, checkpoint, retries):
+    return create_embedding_batched(node, property, worker_model, page_size, checkpoint=checkpoint,
+                                    retries=retries, shard=shard, shards=shards, raise_errors=True)
+
+def create_embedding_parallel(node, property, workers=WORKERS, page_size=PAGE_SIZE, checkpoint=True, retries=MAX_RETRIES):
+    """Function to create embeddings from chunks of the Neo4j database with a pool of
+    workers processes. The pending nodes are split in shards by id modulo workers and
+    each process runs create_embedding_batched over its shard with its own model,
+    driver and checkpoint, using cores // workers threads. The nodes, texts and
+    Embedding nodes written are the same as in the single process run. The shards
+    that did not finish are reported and a RuntimeError is raised after the others end"""
+
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    print(f'WORKERS: {workers} ||| THREADS PER WORKER: {threads}')
+    # spawn: cada proceso empieza sin el estado de torch ni las conexiones del proceso principal
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=init_worker, initargs=(threads,)) as pool:
+        futures = [pool.submit(embed_shard, node, property, shard, workers, page_size, checkpoint, retries)
+                   for shard in range(workers)]
+        count = 0
+        failed = []
+        for shard, future in enumerate(futures):
+            try:
+                count += future.result() or 0
+            except Exception as e:
+                failed.append(shard)
+                print(f'SHARD {shard + 1}/{workers} DID NOT FINISH: {e}')
+
+    print(f'Processed {str(count)} ||| Node: {node} ||| Property: {property} ||| Workers: {workers}')
+    print('-----------------------------------------------------------------')
+    if failed:
+        raise RuntimeError(f'{len(failed)} of {workers} shards of {node} did not finish, run again to process their pending nodes')
+    return count
+
+def migrate_embeddings(batch_size=PAGE_SIZE):
+    """Function to convert the Embedding nodes stored as json strings 
+    into native float lists, reading and writing batch_size nodes at a time"""
+
+    driver = get_driver()
+    read_cypher = """
+        MATCH (e:Embedding) WHERE id(e) > $last_id
+        RETURN id(e) AS id, e.value AS value
+        ORDER BY id ASC LIMIT $batch_size
+    """
+    write_cypher = "UNWIND $rows AS row MATCH (e:Embedding) WHERE id(e) = row.id SET e.value = row.value"
+
+    count = 0
+    with driver.session() as session:
+        last_id = -1
+        while True:
+            page = session.run(read_cypher, last_id=last_id, batch_size=batch_size).data()
+            if not page:
+                break
+            rows = [{"id": row["id"], "value": json.loads(row["value"])} for row in page if isinstance(row["value"], str)]
+            if rows:
+                session.execute_write(lambda tx: tx.run(write_cypher, rows=rows).consume())
+            count += len(rows)
+            last_id = page[-1]["id"]
+            print(f'Migrated {str(count)} embeddings')
+    return count
+
 # Seleccionar los nodos y propiedades para aplicar la función de embeddings
 # Cambiarlo a los nodos de tu base de datos
 nodes_to_process = [("Chunk", "sentences"), ("Table", "name")]
 
-for node in nodes_to_process:
-    print(f'PROCESING {node} TO EMBEDDINGS:')
-    print('-----------------------------------------------------------------')
-    startTimeemb = datetime.now()
-    print(f'START TIME EMB: {startTimeemb}')
-    create_embedding(*node)
-    print(f'END TIME EMB: {datetime.now() - startTimeemb}')
-    print('-----------------------------------------------------------------')
+def main(batched=False, page_size=PAGE_SIZE, migrate=False, checkpoint=True, reset_checkpoint=False, retries=MAX_RETRIES,
+         workers=1):
+    if migrate:
+        migrate_embeddings(page_size)
+        return
+
+    if workers > 1:
+        # La dimensión se calcula en un proceso que termina antes de crear los workers,
+        # así el proceso principal no guarda una copia del modelo mientras ellos cargan la suya
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            dimension = pool.submit(embedding_dimension).result()
+        embed_model = None
+    else:
+        # En el modo por lotes se carga un único modelo para todos los nodos
+        embed_model = embedding_model()
+        dimension = len(embed_model.embed_query('dimension'))
+    if not check_vector_index(NEO4J_URL, NEO4J_USER, NEO4J_PASSWORD, dimension):
+        return
+    if not batched:
+        embed_model = None
+
+    # Descartar los checkpoints de una ejecución anterior, también los de cada shard, para volver a empezar desde el primer nodo
+    if reset_checkpoint:
+        for node, property in nodes_to_process:
+            for path in glob.glob(os.path.join(CHECKPOINT_LOCATION, f'{node}-{property}*.json')):
+                Checkpoint(path).clear()
+
+    for node in nodes_to_process:
+        print(f'PROCESING {node} TO EMBEDDINGS:')
+        print('-----------------------------------------------------------------')
+        with instrumentation.span('embedding_run', node=node[0]) as run_span:
+            if workers > 1:
+                create_embedding_parallel(*node, workers=workers, page_size=page_size,
+                                          checkpoint=checkpoint, retries=retries)
+            elif batched:
+                create_embedding_batched(*node, embed_model=embed_model, page_size=page_size,
+                                         checkpoint=checkpoint, retries=retries)
+            else:
+                create_embedding(*node)
+        print(f'Total time: {timedelta(seconds=run_span.elapsed)}')
+        print('-----------------------------------------------------------------')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Create the embeddings of the nodes in the Neo4j database')
+    parser.add_argument('--batched', action='store_true', help='encode and write the nodes in pages with one model instance')
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE, help='nodes encoded and written per page')
+    parser.add_argument('--migrate', action='store_true', help='convert the embeddings stored as json strings into float lists')
+    parser.add_argument('--no-checkpoint', action='store_true', help='do not save the cursor of the batched mode to resume it')
+    parser.add_argument('--reset-checkpoint', action='store_true', help='start from the first node instead of the saved cursor')
+    parser.add_argument('--retries', type=int, default=MAX_RETRIES, help='retries of each page on transient Neo4j errors')
+    parser.add_argument('--workers', type=int, default=1, help='processes of the batched mode, each one with its own model and shard of nodes')
+    args = parser.parse_args()
+    main(batched=args.batched, page_size=args.page_size, migrate=args.migrate, checkpoint=not args.no_checkpoint,
+         reset_checkpoint=args.reset_checkpoint, retries=args.retries, workers=args.workers)
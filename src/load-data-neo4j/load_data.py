@@ -1,15 +1,24 @@
+import argparse
 import hashlib
 import os
 import glob
+import queue
 import shutil
 import sys
-from datetime import datetime
-from neo4j import GraphDatabase
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from llmsherpa.readers import LayoutPDFReader
+from parse_cache import CachedPDFReader, file_hash, iter_cached_docs
 
 sys.path.append('/Users/nfanlo/dev')
 from config.config import config
 
+#Shared modules with the streamlit application
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from neo4j_driver import get_driver
+import instrumentation
+
 #Change the following variables to your own Neo4j instance
 NEO4J_USER = "neo4j"
 NEO4J_DATABASE = "neo4j"
@@ -21,18 +30,48 @@ llmsherpa_api_url = "https://readers.llmsherpa.com/api/document/developer/parseD
 file_location = os.path.join(os.path.dirname(__file__), 'newdata')
 file_destination = os.path.join(os.path.dirname(__file__), 'dataloaded')
 
+#Number of rows sent in each UNWIND statement of the batched ingestion mode
+BATCH_SIZE = 1000
+
+#Concurrency limits of the pipelined ingestion mode: parser threads, writer threads 
+#and number of parsed documents waiting to be written before the parsers are blocked
+PARSER_WORKERS = 4
+WRITER_WORKERS = 2
+QUEUE_SIZE = 8
+
+#Batched ingestion: UNWIND statements run in order inside one transaction per document
+cypher_batch_pool = [
+    #Section: Create Section nodes from the 'sections' parameter list
+    ("sections", "UNWIND $rows AS row MERGE (p:Section {key: row.key}) ON CREATE SET p.page_idx = row.page_idx, p.title_hash = row.title_hash, p.block_idx = row.block_idx, p.title = row.title, p.tag = row.tag, p.level = row.level;"),
+    #Relationship Doc-Sec: Creates relationship [:HAS_DOCUMENT] from top level Sections to Document
+    ("section_docs", "MATCH (d:Document {url_hash: $doc_url_hash_val}) UNWIND $rows AS row MATCH (s:Section {key: row.key}) MERGE (d)<-[:HAS_DOCUMENT]-(s);"),
+    #Relationship S1-S2: Creates relationship [:UNDER_SECTION] from Section 2 to Section 1
+    ("section_parents", "UNWIND $rows AS row MATCH (s1:Section {key: row.parent_key}) MATCH (s2:Section {key: row.key}) MERGE (s1)<-[:UNDER_SECTION]-(s2);"),
+    #Chunk: Create Chunk nodes from the 'chunks' parameter list
+    ("chunks", "UNWIND $rows AS row MERGE (c:Chunk {key: row.key}) ON CREATE SET c.sentences = row.sentences, c.sentences_hash = row.sentences_hash, c.block_idx = row.block_idx, c.page_idx = row.page_idx, c.tag = row.tag, c.level = row.level SET c.section_path = row.section_path, c.doc_name = row.doc_name, c.doc_url_hash = row.doc_url_hash;"),
+    #Relationship Chunk-Section: Creates relationship [:HAS_PARENT] from Chunk nodes to Section nodes
+    ("chunk_parents", "UNWIND $rows AS row MATCH (c:Chunk {key: row.key}) MATCH (s:Section {key: row.parent_key}) MERGE (s)<-[:HAS_PARENT]-(c);"),
+    #Table: Create Table nodes from the 'tables' parameter list
+    ("tables", "UNWIND $rows AS row MERGE (t:Table {key: row.key}) ON CREATE SET t.name = row.name, t.doc_url_hash = $doc_url_hash_val, t.block_idx = row.block_idx, t.page_idx = row.page_idx, t.html = row.html, t.rows = row.rows SET t.section_path = row.section_path, t.doc_name = row.doc_name;"),
+    #Relationship Table-Section: Creates relationship [:HAS_PARENT] from Table nodes to Section nodes
+    ("table_parents", "UNWIND $rows AS row MATCH (t:Table {key: row.key}) MATCH (s:Section {key: row.parent_key}) MERGE (s)<-[:HAS_PARENT]-(t);"),
+    #Relationship Table-Document: Creates relationship [:HAS_PARENT] from Table nodes without parent Section to Document nodes
+    ("table_docs", "MATCH (d:Document {url_hash: $doc_url_hash_val}) UNWIND $rows AS row MATCH (t:Table {key: row.key}) MERGE (d)<-[:HAS_PARENT]-(t);")]
+
 def test_neo4j(uri, user, password):
     try:
-        driver = GraphDatabase.driver(uri, auth=(user, password))
-        with driver.session() as session:
+        with get_driver(uri, user, password).session() as session:
             result = session.run("MATCH (n) RETURN count(n) AS count")
             node_count = result.single()["count"]
             return node_count > 0
     except Exception as e:
         print(f"Connection failed: {e}")
         return False
-    finally:
-        driver.close()
+
+#Indexes used by the retrieval to fetch the neighbouring chunks of a hit by block_idx
+block_indexes = [
+    "CREATE INDEX chunkDocumentBlock IF NOT EXISTS FOR (c:Chunk) ON (c.doc_url_hash, c.block_idx);",
+    "CREATE INDEX tableDocumentBlock IF NOT EXISTS FOR (t:Table) ON (t.doc_url_hash, t.block_idx);"]
 
 def schemaNeo4j():
     """Function to initialize Neo4j main schema 
@@ -43,22 +82,23 @@ def schemaNeo4j():
         "CREATE CONSTRAINT chunkKey IF NOT EXISTS FOR (c:Chunk) REQUIRE (c.key) IS UNIQUE;",
         "CREATE CONSTRAINT documentKey IF NOT EXISTS FOR (c:Document) REQUIRE (c.url_hash) IS UNIQUE;",
         "CREATE CONSTRAINT tableKey IF NOT EXISTS FOR (c:Table) REQUIRE (c.key) IS UNIQUE;",
+        "CREATE INDEX documentContentHash IF NOT EXISTS FOR (d:Document) ON (d.content_hash);",
+        *block_indexes,
         "CALL db.index.vector.createNodeIndex('chunkVectorIndex', 'Embedding', 'value', 384, 'COSINE');"]
     
-    driver = GraphDatabase.driver(NEO4J_URL, database=NEO4J_DATABASE, auth=(NEO4J_USER, NEO4J_PASSWORD))
-    with driver.session() as session:
+    with get_driver().session() as session:
         for cypher in cypher_schema:
             session.run(cypher)
-    driver.close()
 
-def processpdfNeo4j(doc, doc_location):
+def processpdfNeo4j(doc, doc_location, driver=None):
     """Function to process pdf files to the Neo4j Aura database. 
     The function expects a json opened with the LayoutPDFReader 
-    library to preprocess in the doc variable and the pdf opened in pdf_file"""
+    library to preprocess in the doc variable and the pdf opened in pdf_file. 
+    A driver can be passed, otherwise the shared driver of the process is used"""
 
     cypher_pool = [
     #Document: Create Document node with 'url_hash' and 'doc_name' from document loaded
-    "MERGE (d:Document {url_hash: $doc_url_hash_val, name: $doc_name_val}) ON CREATE SET d.url = $doc_url_val RETURN d;",  
+    "MERGE (d:Document {url_hash: $doc_url_hash_val, name: $doc_name_val}) ON CREATE SET d.url = $doc_url_val SET d.updated_at = timestamp() RETURN d;",  
     #Section: Create Section node with doc_name and url_hash with properties of document loaded
     "MERGE (p:Section {key: $doc_name_val + '_' + $doc_url_hash_val + '|' + $block_idx_val + '|' + $title_hash_val}) ON CREATE SET p.page_idx = $page_idx_val, p.title_hash = $title_hash_val, p.block_idx = $block_idx_val, p.title = $title_val, p.tag = $tag_val, p.level = $level_val RETURN p;",
     #Relationship Doc-Sec: Creates relationship [:HAS_DOCUMENT] from Section to Document
@@ -66,21 +106,19 @@ def processpdfNeo4j(doc, doc_location):
     #Relationship S1-S2: Creates relationship [:UNDER_SECTION] from Section 2 to Section 1
     "MATCH (s1:Section {key: $doc_name_val + '_' + $doc_url_hash_val + '|' + $parent_block_idx_val + '|' + $parent_title_hash_val}) MATCH (s2:Section {key: $doc_name_val + '_' + $doc_url_hash_val + '|' + $block_idx_val + '|' + $title_hash_val}) MERGE (s1)<-[:UNDER_SECTION]-(s2);",
     #Chunk: Create Chunk node with 'doc_name', 'url_hash', 'sentences_val', 'sentences_hash', 'block_id', 'page_id', 'tag_val' and 'c_level'
-    "MERGE (c:Chunk {key: $doc_name_val + '_' + $doc_url_hash_val + '|' + $block_idx_val + '|' + $sentences_hash_val}) ON CREATE SET c.sentences = $sentences_val, c.sentences_hash = $sentences_hash_val, c.block_idx = $block_idx_val, c.page_idx = $page_idx_val, c.tag = $tag_val, c.level = $level_val RETURN c;",
+    "MERGE (c:Chunk {key: $doc_name_val + '_' + $doc_url_hash_val + '|' + $block_idx_val + '|' + $sentences_hash_val}) ON CREATE SET c.sentences = $sentences_val, c.sentences_hash = $sentences_hash_val, c.block_idx = $block_idx_val, c.page_idx = $page_idx_val, c.tag = $tag_val, c.level = $level_val SET c.section_path = $section_path_val, c.doc_name = $doc_name_val, c.doc_url_hash = $doc_url_hash_val RETURN c;",
     #Relationship Chunk-Section: Creates relationship [:HAS_PARENT] from Chunk nodes to Section nodes
     "MATCH (c:Chunk {key: $doc_name_val + '_' + $doc_url_hash_val + '|' + $block_idx_val + '|' + $sentences_hash_val}) MATCH (s:Section {key:$doc_name_val + '_' + $doc_url_hash_val + '|' + $parent_block_idx_val + '|' + $parent_hash_val}) MERGE (s)<-[:HAS_PARENT]-(c);",
     #Table: Create Table nodes with 'doc_name', 'url_hash', 'block_id', 'name_val', 'page_id', 'html_val', 'rows_val'
-    "MERGE (t:Table {key: $doc_name_val + '_' + $doc_url_hash_val + '|' + $block_idx_val + '|' + $name_val}) ON CREATE SET t.name = $name_val, t.doc_url_hash = $doc_url_hash_val, t.block_idx = $block_idx_val, t.page_idx = $page_idx_val, t.html = $html_val, t.rows = $rows_val RETURN t;",
+    "MERGE (t:Table {key: $doc_name_val + '_' + $doc_url_hash_val + '|' + $block_idx_val + '|' + $name_val}) ON CREATE SET t.name = $name_val, t.doc_url_hash = $doc_url_hash_val, t.block_idx = $block_idx_val, t.page_idx = $page_idx_val, t.html = $html_val, t.rows = $rows_val SET t.section_path = $section_path_val, t.doc_name = $doc_name_val RETURN t;",
     #Relationship Table-Section: Creates relationship [:HAS_PARENT] from Table nodes to Section nodes
     "MATCH (t:Table {key: $doc_name_val + '_' + $doc_url_hash_val + '|' + $block_idx_val + '|' + $name_val}) MATCH (s:Section {key: $doc_name_val + '_' + $doc_url_hash_val + '|' + $parent_block_idx_val + '|' + $parent_hash_val}) MERGE (s)<-[:HAS_PARENT]-(t);",
     #Relationship Table-Document: Creates relationship [:HAS_PARENT] from Table nodes to Document nodes if Table nodes dont have [HAS_PARENT] Section
     "MATCH (t:Table {key: $doc_name_val + '_' + $doc_url_hash_val + '|' + $block_idx_val + '|' + $name_val}) MATCH (d:Document {url_hash: $doc_url_hash_val}) MERGE (d)<-[:HAS_PARENT]-(t);"]
 
-    driver = GraphDatabase.driver(NEO4J_URL, database=NEO4J_DATABASE, auth=(NEO4J_USER, NEO4J_PASSWORD))
-    with driver.session() as session:
-        startTimedb = datetime.now()
-        print(f'START TIME PROCESSING PDF FILE TO DB: {startTimedb}')
-
+    if driver is None:
+        driver = get_driver()
+    with driver.session() as session, instrumentation.span('ingest_document', mode='rows') as document_span:
         doc_name_val = os.path.basename(doc_location)[:-4]
         doc_url_val = doc_location
         doc_url_hash_val = hashlib.md5(doc_url_val.encode("utf-8")).hexdigest()
@@ -152,6 +190,7 @@ def processpdfNeo4j(doc, doc_location):
                             page_idx_val=chunk_page_idx_val,
                             tag_val=chunk_tag_val,
                             level_val=chunk_level_val,
+                            section_path_val=section_path(chk),
                             doc_name_val=doc_name_val,
                             doc_url_hash_val=doc_url_hash_val)
 
@@ -184,6 +223,7 @@ def processpdfNeo4j(doc, doc_location):
                         name_val=name_val,
                         html_val=html_val,
                         rows_val=rows_val,
+                        section_path_val=section_path(tb),
                         doc_name_val=doc_name_val,
                         doc_url_hash_val=doc_url_hash_val)
 
@@ -210,54 +250,455 @@ def processpdfNeo4j(doc, doc_location):
             countTable += 1
         countDocument += 1
 
-        print('DOCUMENT PROCESSED')
-        print('-----------------------------------------------------------------')
-        print(f'\'{doc_name_val}\' SUMMARY: ')
-        print('SECTIONS: ' + str(countSection))
-        print('CHUNKS: ' + str(countChunk))
-        print('TABLES: ' + str(countTable))
-        print(f'Total time: {datetime.now() - startTimedb}')
-        print('-----------------------------------------------------------------')
+    summary_doc(doc_name_val, countSection, countChunk, countTable, document_span.elapsed)
     print('TOTAL DOCUMENTS PROCESSED:'+' '+str(countDocument))
 
-    driver.close()
+def summary_doc(doc_name_val, countSection, countChunk, countTable, elapsed):
+    print('DOCUMENT PROCESSED')
+    print('-----------------------------------------------------------------')
+    print(f'\'{doc_name_val}\' SUMMARY: ')
+    print('SECTIONS: ' + str(countSection))
+    print('CHUNKS: ' + str(countChunk))
+    print('TABLES: ' + str(countTable))
+    print(f'Total time: {timedelta(seconds=elapsed)}')
+    print('-----------------------------------------------------------------')
+
+def md5_hex(text):
+    return hashlib.md5(text.encode("utf-8")).hexdigest()
+
+def node_key(doc_name_val, doc_url_hash_val, block_idx_val, hash_val):
+    """Function that builds the key of Section, Chunk and Table nodes. 
+    It matches the key expression used by the statements in cypher_pool"""
+
+    return doc_name_val + '_' + doc_url_hash_val + '|' + str(block_idx_val) + '|' + hash_val
+
+def section_path(block):
+    """Function that returns the titles of the sections above a block, from the 
+    top level section to its parent, separated by ' > '. It is stored on Chunk and 
+    Table nodes so the retrieval does not traverse the sections for each hit"""
+
+    titles = []
+    parent = block.parent
+    while parent is not None:
+        if parent.tag == 'header':
+            titles.append(parent.title)
+        parent = parent.parent
+    return ' > '.join(reversed(titles))
+
+def collect_doc_rows(doc, doc_location):
+    """Function that collects the sections, chunks, tables and their relationships 
+    of a document opened with LayoutPDFReader into the parameter lists used by 
+    the UNWIND statements in cypher_batch_pool"""
+
+    doc_name_val = os.path.basename(doc_location)[:-4]
+    doc_url_hash_val = md5_hex(doc_location)
+    rows = {name: [] for name, _ in cypher_batch_pool}
+
+    for sec in doc.sections():
+        if sec.tag == 'table':
+            continue
+        sec_title_hash_val = md5_hex(sec.title)
+        sec_key = node_key(doc_name_val, doc_url_hash_val, sec.block_idx, sec_title_hash_val)
+        rows["sections"].append({"key": sec_key,
+                                 "page_idx": sec.page_idx,
+                                 "title_hash": sec_title_hash_val,
+                                 "block_idx": sec.block_idx,
+                                 "title": sec.title,
+                                 "tag": sec.tag,
+                                 "level": sec.level})
+
+        sec_parent_val = str(sec.parent.to_text())
+        if sec_parent_val == "None":
+            rows["section_docs"].append({"key": sec_key})
+        else:
+            parent_key = node_key(doc_name_val, doc_url_hash_val, sec.parent.block_idx, md5_hex(sec_parent_val))
+            rows["section_parents"].append({"key": sec_key, "parent_key": parent_key})
+
+    for chk in doc.chunks():
+        if chk.tag == 'table':
+            continue
+        chunk_sentences = "\n".join(chk.sentences)
+        chunk_sentences_hash_val = md5_hex(chunk_sentences)
+        chunk_key = node_key(doc_name_val, doc_url_hash_val, chk.block_idx, chunk_sentences_hash_val)
+        rows["chunks"].append({"key": chunk_key,
+                               "sentences": chunk_sentences,
+                               "sentences_hash": chunk_sentences_hash_val,
+                               "block_idx": chk.block_idx,
+                               "page_idx": chk.page_idx,
+                               "tag": chk.tag,
+                               "level": chk.level,
+                               "section_path": section_path(chk),
+                               "doc_name": doc_name_val,
+                               "doc_url_hash": doc_url_hash_val})
+
+        chk_parent_val = str(chk.parent.to_text())
+        if not chk_parent_val == "None":
+            parent_key = node_key(doc_name_val, doc_url_hash_val, chk.parent.block_idx, md5_hex(chk_parent_val))
+            rows["chunk_parents"].append({"key": chunk_key, "parent_key": parent_key})
+
+    for tb in doc.tables():
+        name_val = 'block#' + str(tb.block_idx) + '_' + tb.name
+        table_key = node_key(doc_name_val, doc_url_hash_val, tb.block_idx, name_val)
+        rows["tables"].append({"key": table_key,
+                               "name": name_val,
+                               "block_idx": tb.block_idx,
+                               "page_idx": tb.page_idx,
+                               "html": tb.to_html(),
+                               "rows": len(tb.rows),
+                               "section_path": section_path(tb),
+                               "doc_name": doc_name_val})
+
+        table_parent_val = str(tb.parent.to_text())
+        if not table_parent_val == "None":
+            parent_key = node_key(doc_name_val, doc_url_hash_val, tb.parent.block_idx, md5_hex(table_parent_val))
+            rows["table_parents"].append({"key": table_key, "parent_key": parent_key})
+        else:
+            rows["table_docs"].append({"key": table_key})
+
+    return doc_name_val, doc_url_hash_val, rows
+
+def write_doc_rows(tx, doc_name_val, doc_url_hash_val, doc_url_val, rows, batch_size=BATCH_SIZE):
+    """Transaction function that writes the parameter lists of collect_doc_rows 
+    with the UNWIND statements in cypher_batch_pool, batch_size rows per statement"""
+
+    tx.run("MERGE (d:Document {url_hash: $doc_url_hash_val, name: $doc_name_val}) ON CREATE SET d.url = $doc_url_val SET d.updated_at = timestamp();",
+           doc_url_hash_val=doc_url_hash_val, doc_name_val=doc_name_val, doc_url_val=doc_url_val).consume()
+    for name, cypher in cypher_batch_pool:
+        batch_rows = rows[name]
+        for start in range(0, len(batch_rows), batch_size):
+            with instrumentation.span('ingest_cypher_batch', statement=name):
+                tx.run(cypher, rows=batch_rows[start:start + batch_size], doc_url_hash_val=doc_url_hash_val).consume()
+            instrumentation.count('ingest_rows', len(batch_rows[start:start + batch_size]), statement=name)
+
+def processpdfNeo4jBatch(doc, doc_location, batch_size=BATCH_SIZE, driver=None):
+    """Function to process pdf files to the Neo4j Aura database in batches. 
+    It creates the same nodes and relationships as processpdfNeo4j, but sends them 
+    as UNWIND parameter lists of batch_size rows inside one transaction per document"""
+
+    with instrumentation.span('ingest_document', mode='batched') as document_span:
+        with instrumentation.span('ingest_collect_rows'):
+            doc_name_val, doc_url_hash_val, rows = collect_doc_rows(doc, doc_location)
+
+        if driver is None:
+            driver = get_driver()
+        with driver.session() as session:
+            session.execute_write(write_doc_rows, doc_name_val, doc_url_hash_val, doc_location, rows, batch_size)
+
+    summary_doc(doc_name_val, len(doc.sections()), len(doc.chunks()), len(doc.tables()), document_span.elapsed)
 
 def move_file_to_loaded_folder(filename):
     if not os.path.exists(file_destination):
         os.makedirs(file_destination)
     shutil.move(filename, os.path.join(file_destination, os.path.basename(filename)))
 
-def main():
+def stored_doc_nodes(tx, label, prefix):
+    """Transaction function that returns the parent Section key and the section path
+    of the label nodes stored for the document with the given key prefix, by key"""
+
+    result = tx.run(f"MATCH (n:{label}) WHERE n.key STARTS WITH $prefix "
+                    "OPTIONAL MATCH (n)-[:HAS_PARENT|UNDER_SECTION]->(p:Section) "
+                    "RETURN n.key AS key, p.key AS parent_key, n.section_path AS section_path", prefix=prefix)
+    return {record["key"]: {"parent_key": record["parent_key"], "section_path": record["section_path"]}
+            for record in result}
+
+def node_identity(label, key, parent_key):
+    """Function that returns what identifies a node regardless of its position in the
+    document: the hash of its text (the name for tables) and the title hash of its parent
+    Section. The embedded text of a chunk only depends on both, so a chunk moved by an
+    inserted paragraph keeps its identity and its embedding. The name of a table starts
+    with its block number, which is left out here so a moved table keeps its node, but
+    its embedded name changes and write_doc_diff clears its embedding"""
+
+    text_hash = key.rsplit('|', 1)[-1]
+    if label == "Table":
+        text_hash = text_hash.split('_', 1)[-1]
+    return text_hash, (parent_key or '').rsplit('|', 1)[-1]
+
+def key_block_idx(key):
+    return int(key.rsplit('|', 2)[-2])
+
+def match_moved_nodes(label, added, removed, new, stored):
+    """Function that pairs the added and removed keys with the same identity,
+    in block order, and returns the pairs as (old key, new key)"""
+
+    removed_keys = {}
+    for key in sorted(removed, key=key_block_idx):
+        removed_keys.setdefault(node_identity(label, key, stored[key]["parent_key"]), []).append(key)
+    moved = []
+    for key in sorted(added, key=key_block_idx):
+        candidates = removed_keys.get(node_identity(label, key, new[key]))
+        if candidates:
+            moved.append((candidates.pop(0), key))
+    return moved
+
+def write_doc_diff(tx, doc_name_val, doc_url_hash_val, doc_url_val, content_hash, rows, batch_size=BATCH_SIZE):
+    """Transaction function that compares the parameter lists of collect_doc_rows with the 
+    nodes stored for the document. Removed nodes are deleted with their Embedding nodes, 
+    new nodes are created, nodes that only moved (same text and parent title in another 
+    block) get the new key, block_idx and page_idx, nodes with a new parent Section are
+    relinked, the section paths are updated and only the Chunk and Table nodes whose
+    embedded text changed (including every moved Table) lose their embedding"""
+
+    prefix = doc_name_val + '_' + doc_url_hash_val + '|'
+    node_rows = {"Section": ("sections", ["section_docs", "section_parents"]),
+                 "Chunk": ("chunks", ["chunk_parents"]),
+                 "Table": ("tables", ["table_parents", "table_docs"])}
+
+    diff_rows = {name: [] for name, _ in cypher_batch_pool}
+    countChanges = {"added": 0, "removed": 0, "moved": 0, "relinked": 0}
+    #Old key -> new key of the moved nodes. Sections are compared first, so the parents of the chunks and tables are known
+    renamed = {}
+    for label, (nodes_name, edges_names) in node_rows.items():
+        with instrumentation.span('ingest_stored_keys', label=label):
+            stored = stored_doc_nodes(tx, label, prefix)
+        node_values = {row["key"]: row for row in rows[nodes_name]}
+        new = {key: None for key in node_values}
+        for edges_name in edges_names:
+            for row in rows[edges_name]:
+                new[row["key"]] = row.get("parent_key")
+
+        added = new.keys() - stored.keys()
+        removed = stored.keys() - new.keys()
+        moved = match_moved_nodes(label, added, removed, new, stored)
+        for old_key, key in moved:
+            renamed[old_key] = key
+            stored[key] = stored.pop(old_key)
+        added -= {key for _, key in moved}
+        removed = list(removed - {old_key for old_key, _ in moved})
+        stored_parent = {key: renamed.get(value["parent_key"], value["parent_key"]) for key, value in stored.items()}
+        relinked = {key for key in new.keys() & stored.keys() if new[key] != stored_parent[key]}
+        #The embedded text is the parent Section title + the node text, so it only changes with the parent title hash
+        text_changed = [key for key in relinked
+                        if (new[key] or '').rsplit('|', 1)[-1] != (stored_parent[key] or '').rsplit('|', 1)[-1]]
+        #The embedded name of a table starts with its block number, so a moved table is embedded again
+        if label == "Table":
+            text_changed = list(set(text_changed) | {key for _, key in moved})
+
+        tx.run(f"UNWIND $rows AS row MATCH (n:{label} {{key: row.old_key}}) "
+               "SET n.key = row.key, n.block_idx = row.block_idx, n.page_idx = row.page_idx, n.name = coalesce(row.name, n.name)",
+               rows=[{"old_key": old_key, "key": key, "block_idx": node_values[key]["block_idx"],
+                      "page_idx": node_values[key]["page_idx"], "name": node_values[key].get("name")}
+                     for old_key, key in moved]).consume()
+        tx.run(f"UNWIND $keys AS key MATCH (n:{label} {{key: key}}) "
+               "OPTIONAL MATCH (n)-[:HAS_EMBEDDING]->(e:Embedding) DETACH DELETE e, n", keys=removed).consume()
+        tx.run(f"UNWIND $keys AS key MATCH (n:{label} {{key: key}})-[r:HAS_PARENT|UNDER_SECTION|HAS_DOCUMENT]->() "
+               "DELETE r", keys=list(relinked)).consume()
+        tx.run(f"UNWIND $keys AS key MATCH (n:{label} {{key: key}}) "
+               "OPTIONAL MATCH (n)-[:HAS_EMBEDDING]->(e:Embedding) DETACH DELETE e "
+               "SET n.embedding_created = null", keys=text_changed).consume()
+
+        #The node statements also update the section path of the stored Chunk and Table nodes
+        diff_rows[nodes_name] = [row for row in rows[nodes_name] if row["key"] in added
+                                 or ("section_path" in row and row["section_path"] != stored.get(row["key"], {}).get("section_path"))]
+        for edges_name in edges_names:
+            diff_rows[edges_name] = [row for row in rows[edges_name] if row["key"] in added or row["key"] in relinked]
+
+        countChanges["added"] += len(added)
+        countChanges["removed"] += len(removed)
+        countChanges["moved"] += len(moved)
+        countChanges["relinked"] += len(relinked)
+
+    write_doc_rows(tx, doc_name_val, doc_url_hash_val, doc_url_val, diff_rows, batch_size)
+    tx.run("MATCH (d:Document {url_hash: $doc_url_hash_val}) SET d.content_hash = $content_hash",
+           doc_url_hash_val=doc_url_hash_val, content_hash=content_hash).consume()
+    return countChanges
+
+def processpdfNeo4jIncremental(doc, doc_location, content_hash=None, batch_size=BATCH_SIZE, driver=None):
+    """Function to process pdf files to the Neo4j Aura database incrementally. 
+    Documents are identified by the hash of their content: an unchanged document is skipped, 
+    even if it was renamed, and an updated document with the same location only writes 
+    the difference with the nodes already stored"""
+
+    with instrumentation.span('ingest_document', mode='incremental') as document_span:
+        if content_hash is None:
+            content_hash = file_hash(doc_location)
+        with instrumentation.span('ingest_collect_rows'):
+            doc_name_val, doc_url_hash_val, rows = collect_doc_rows(doc, doc_location)
+
+        if driver is None:
+            driver = get_driver()
+        with driver.session() as session:
+            stored_doc = session.run("MATCH (d:Document) WHERE d.content_hash = $content_hash "
+                                     "RETURN d.name AS name LIMIT 1", content_hash=content_hash).single()
+            if stored_doc is None:
+                countChanges = session.execute_write(write_doc_diff, doc_name_val, doc_url_hash_val, doc_location,
+                                                     content_hash, rows, batch_size)
+
+    if stored_doc is not None:
+        print(f'\'{doc_name_val}\' HAS THE SAME CONTENT AS \'{stored_doc["name"]}\', SKIPPING')
+        print('-----------------------------------------------------------------')
+    else:
+        print(f'ADDED: {countChanges["added"]} ||| REMOVED: {countChanges["removed"]} ||| MOVED: {countChanges["moved"]} ||| RELINKED: {countChanges["relinked"]}')
+        summary_doc(doc_name_val, len(doc.sections()), len(doc.chunks()), len(doc.tables()), document_span.elapsed)
+
+def process_document(doc, doc_location, batched=False, batch_size=BATCH_SIZE, incremental=False,
+                     content_hash=None, driver=None):
+    """Function that writes a document with the selected ingestion mode"""
+
+    if incremental:
+        processpdfNeo4jIncremental(doc, doc_location, content_hash, batch_size, driver=driver)
+    elif batched:
+        processpdfNeo4jBatch(doc, doc_location, batch_size, driver=driver)
+    else:
+        processpdfNeo4j(doc, doc_location, driver=driver)
+    instrumentation.count('ingest_documents')
+
+def ingest_pipeline(pdf_files, pdf_reader, driver, batched=False, batch_size=BATCH_SIZE,
+                    parser_workers=PARSER_WORKERS, writer_workers=WRITER_WORKERS, queue_size=QUEUE_SIZE,
+                    on_loaded=move_file_to_loaded_folder, incremental=False):
+    """Function to process pdf files overlapping the parser calls with the database writes. 
+    A pool of parser_workers threads reads the pdf files with pdf_reader and puts the documents 
+    in a queue of queue_size items, blocking the parsers while the writers are behind. 
+    writer_workers threads drain the queue, write each document with the driver and call 
+    on_loaded with the pdf file. Returns the list of pdf files loaded"""
+
+    parsed_docs = queue.Queue(maxsize=queue_size)
+    loaded_files = []
+
+    def parse(pdf_file):
+        try:
+            with instrumentation.span('ingest_parse'):
+                doc = pdf_reader.read_pdf(pdf_file)
+        except Exception as e:
+            print(f"An error occurred while parsing {pdf_file}: {e}")
+            return
+        parsed_docs.put((pdf_file, doc))
+
+    def write():
+        while True:
+            item = parsed_docs.get()
+            if item is None:
+                break
+            pdf_file, doc = item
+            try:
+                process_document(doc, pdf_file, batched, batch_size, incremental, driver=driver)
+                on_loaded(pdf_file)
+                loaded_files.append(pdf_file)
+            except Exception as e:
+                print(f"An error occurred while processing {pdf_file}: {e}")
+
+    writers = [threading.Thread(target=write, daemon=True) for _ in range(writer_workers)]
+    for writer in writers:
+        writer.start()
+
+    with ThreadPoolExecutor(max_workers=parser_workers) as parsers:
+        list(parsers.map(parse, pdf_files))
+
+    #One stop signal for each writer once every document has been parsed
+    for _ in writers:
+        parsed_docs.put(None)
+    for writer in writers:
+        writer.join()
+
+    return loaded_files
+
+def replay_parse_cache(batched=False, batch_size=BATCH_SIZE, incremental=False):
+    """Function that rebuilds the graph from the documents in the parse cache 
+    without calling the pdf parser or moving any file"""
+
+    countDocument = 0
+    for content_hash, doc_location, doc in iter_cached_docs():
+        try:
+            process_document(doc, doc_location, batched, batch_size, incremental, content_hash)
+            countDocument += 1
+        except Exception as e:
+            print(f"An error occurred while processing {doc_location} from parse cache: {e}")
+    return countDocument
+
+#Backfill: section path, document name and url hash of the Chunk and Table nodes loaded before they were stored
+backfill_query = """
+MATCH (n:{label}) WHERE id(n) > $last_id
+WITH n ORDER BY id(n) LIMIT $batch_size
+OPTIONAL MATCH (n)-[:HAS_PARENT]->(s:Section)
+OPTIONAL MATCH p = (s)-[:UNDER_SECTION*0..]->(top:Section) WHERE NOT (top)-[:UNDER_SECTION]->()
+WITH n, split(n.key, '|')[0] AS prefix, [x IN reverse(coalesce(nodes(p), [])) | x.title] AS titles
+SET n.doc_name = left(prefix, size(prefix) - 33),
+    n.doc_url_hash = right(prefix, 32),
+    n.section_path = reduce(path = '', title IN titles | path + CASE path WHEN '' THEN '' ELSE ' > ' END + title)
+RETURN count(n) AS updated, max(id(n)) AS last_id
+"""
+
+def backfill_section_paths(batch_size=BATCH_SIZE):
+    """Function that stores the section path, document name and url hash on the Chunk 
+    and Table nodes of documents loaded before these properties were written at ingestion, 
+    and creates the (doc_url_hash, block_idx) indexes used to fetch neighbouring chunks"""
+
+    driver = get_driver()
+    with driver.session() as session:
+        for cypher in block_indexes:
+            session.run(cypher).consume()
+        for label in ("Chunk", "Table"):
+            count = 0
+            last_id = -1
+            while True:
+                record = session.execute_write(lambda tx: tx.run(backfill_query.format(label=label),
+                                                                 last_id=last_id, batch_size=batch_size).single())
+                if not record["updated"]:
+                    break
+                count += record["updated"]
+                last_id = record["last_id"]
+            print(f'{label} NODES UPDATED: {count}')
+
+def main(batched=False, batch_size=BATCH_SIZE, pipeline=False, parser_workers=PARSER_WORKERS,
+         writer_workers=WRITER_WORKERS, queue_size=QUEUE_SIZE, replay_cache=False, incremental=False,
+         backfill_paths=False):
     if not test_neo4j(NEO4J_URL, NEO4J_USER, NEO4J_PASSWORD):
         schemaNeo4j()
 
+    if backfill_paths:
+        backfill_section_paths(batch_size)
+        return
+
+    if replay_cache:
+        with instrumentation.span('ingest_run', source='parse_cache') as run_span:
+            countDocument = replay_parse_cache(batched, batch_size, incremental)
+        print(f'DOCUMENTS REPLAYED FROM PARSE CACHE: {countDocument}')
+        print(f'Total time: {timedelta(seconds=run_span.elapsed)}')
+        print('-----------------------------------------------------------------')
+        print('DATA LOADING PROCESS COMPLETED')
+        return
+
     pdf_files = glob.glob(file_location + '/*.pdf')
     print('-----------------------------------------------------------------')
     print(f'TOTAL PDF FILES FOUND: {len(pdf_files)}')
 
-    pdf_reader = LayoutPDFReader(llmsherpa_api_url)
-    startTime = datetime.now()
-    print(f'START TIME: {startTime}')
-    for pdf_file in pdf_files:
-        try:
-            doc = pdf_reader.read_pdf(pdf_file)
+    #Documents already parsed are rebuilt from the parse cache instead of calling llmsherpa
+    pdf_reader = CachedPDFReader(LayoutPDFReader(llmsherpa_api_url))
 
-            json_filename = os.path.splitext(pdf_file)[0] + '.json'
+    with instrumentation.span('ingest_run', source='pdf') as run_span:
+        if pipeline:
+            loaded_files = ingest_pipeline(pdf_files, pdf_reader, get_driver(), batched, batch_size,
+                                           parser_workers, writer_workers, queue_size, incremental=incremental)
+            print(f'FILES LOADED: {len(loaded_files)}')
+        else:
+            for pdf_file in pdf_files:
+                try:
+                    with instrumentation.span('ingest_parse'):
+                        doc = pdf_reader.read_pdf(pdf_file)
 
-            with open(json_filename, 'w') as f:
-                f.write(str(doc.json))
-                
-            processpdfNeo4j(doc, pdf_file)
-            move_file_to_loaded_folder(pdf_file)
+                    process_document(doc, pdf_file, batched, batch_size, incremental)
+                    move_file_to_loaded_folder(pdf_file)
 
-            print(f'Moving file to /dataloaded folder...')
-            os.remove(json_filename)
+                    print(f'Moving file to /dataloaded folder...')
 
-        except Exception as e:
-            print(f"An error occurred while processing {pdf_file}: {e}")
-    print(f'Total time: {datetime.now() - startTime}')
+                except Exception as e:
+                    print(f"An error occurred while processing {pdf_file}: {e}")
+    print(f'Total time: {timedelta(seconds=run_span.elapsed)}')
     print('-----------------------------------------------------------------')
     print('DATA LOADING PROCESS COMPLETED')
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description='Load the pdf files in /newdata to the Neo4j database')
+    parser.add_argument('--batched', action='store_true', help='write each document with UNWIND batches in one transaction')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='rows sent in each UNWIND statement')
+    parser.add_argument('--pipeline', action='store_true', help='overlap the pdf parsing with the database writes')
+    parser.add_argument('--parser-workers', type=int, default=PARSER_WORKERS, help='concurrent calls to the pdf parser')
+    parser.add_argument('--writer-workers', type=int, default=WRITER_WORKERS, help='concurrent documents written to the database')
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE, help='parsed documents waiting to be written')
+    parser.add_argument('--replay-cache', action='store_true', help='rebuild the graph only from the parse cache')
+    parser.add_argument('--incremental', action='store_true', help='write only the difference with the stored documents')
+    parser.add_argument('--backfill-paths', action='store_true', help='store the section path of the chunks and tables already loaded')
+    args = parser.parse_args()
+    main(batched=args.batched, batch_size=args.batch_size, pipeline=args.pipeline, parser_workers=args.parser_workers,
+         writer_workers=args.writer_workers, queue_size=args.queue_size, replay_cache=args.replay_cache,
+         incremental=args.incremental, backfill_paths=args.backfill_paths)
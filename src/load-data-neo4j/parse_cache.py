@@ -0,0 +1,94 @@
+import gzip
+import glob
+import hashlib
+import json
+import os
+import time
+from llmsherpa.readers import Document
+
+#Folder where the layout json returned by llmsherpa is kept, one compressed file per pdf content
+cache_location = os.path.join(os.path.dirname(__file__), 'parsecache')
+
+def file_hash(path):
+    """Function that returns the sha256 of the content of a file"""
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def cache_path(content_hash):
+    return os.path.join(cache_location, content_hash + '.json.gz')
+
+def save_cached_doc(content_hash, doc_location, doc):
+    """Function that saves the layout json of a parsed document in the parse cache
+    together with the location of the pdf it was read from and the time it was saved"""
+
+    if not os.path.exists(cache_location):
+        os.makedirs(cache_location)
+    tmp_path = cache_path(content_hash) + '.tmp'
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+        json.dump({"doc_location": doc_location, "saved_at": time.time(), "blocks": doc.json}, f)
+    os.replace(tmp_path, cache_path(content_hash))
+
+def read_cache_entry(content_hash):
+    path = cache_path(content_hash)
+    if not os.path.exists(path):
+        return None
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        cached = json.load(f)
+    # The entries saved before saved_at was stored use the time of the file
+    cached.setdefault("saved_at", os.path.getmtime(path))
+    return cached
+
+def load_cached_doc(content_hash):
+    """Function that rebuilds a Document from the parse cache.
+    Returns the location of the original pdf and the Document, or None if it is not cached"""
+
+    cached = read_cache_entry(content_hash)
+    if cached is None:
+        return None
+    return cached["doc_location"], Document(cached["blocks"])
+
+def iter_cached_docs():
+    """Function that yields the content hash, the pdf location and the Document of
+    the newest version of every pdf location in the parse cache, in location order.
+    The versions replaced by an updated pdf stay in the cache but are not yielded"""
+
+    newest = {}
+    for path in glob.glob(os.path.join(cache_location, '*.json.gz')):
+        content_hash = os.path.basename(path)[:-len('.json.gz')]
+        cached = read_cache_entry(content_hash)
+        if cached is None:
+            continue
+        location = cached["doc_location"]
+        if location not in newest or cached["saved_at"] > newest[location][0]:
+            newest[location] = (cached["saved_at"], content_hash)
+
+    for location, (_, content_hash) in sorted(newest.items()):
+        cached = load_cached_doc(content_hash)
+        if cached is not None:
+            yield (content_hash, *cached)
+
+class CachedPDFReader:
+    """Reader with the read_pdf method of LayoutPDFReader that returns the Document
+    from the parse cache when the content of the pdf was already parsed.
+    With cache_only the parser is never called and missing pdfs raise an error"""
+
+    def __init__(self, pdf_reader=None, cache_only=False):
+        self.pdf_reader = pdf_reader
+        self.cache_only = cache_only
+
+    def read_pdf(self, pdf_file):
+        content_hash = file_hash(pdf_file)
+        cached = load_cached_doc(content_hash)
+        if cached is not None:
+            print(f'Reading {os.path.basename(pdf_file)} from parse cache...')
+            return cached[1]
+        if self.cache_only or self.pdf_reader is None:
+            raise FileNotFoundError(f'{pdf_file} is not in the parse cache')
+
+        doc = self.pdf_reader.read_pdf(pdf_file)
+        save_cached_doc(content_hash, pdf_file, doc)
+        return doc
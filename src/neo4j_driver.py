@@ -0,0 +1,117 @@
+import atexit
+import sys
+import threading
+import time
+from neo4j import GraphDatabase
+
+sys.path.append('/Users/nfanlo/dev')
+from config.config import config
+
+#Change the following variables to your own Neo4j instance
+NEO4J_USER = "neo4j"
+NEO4J_DATABASE = "neo4j"
+NEO4J_PASSWORD = config["neo4j_password"]
+NEO4J_URL = config["neo4j_url"]
+
+#Maximum connections kept open by each driver, shared by all the threads of the process
+POOL_SIZE = config.get("neo4j_pool_size", 50)
+#Seconds a connectivity probe and the node statistics are reused before querying Neo4j again
+HEALTH_TTL = 30
+STATS_TTL = 300
+
+_drivers = {}
+_health = {}
+_stats = {}
+_lock = threading.Lock()
+
+def get_driver(uri=NEO4J_URL, user=NEO4J_USER, password=NEO4J_PASSWORD, pool_size=POOL_SIZE):
+    """Function that returns the pooled driver shared by the whole process for
+    the given instance, creating it the first time it is requested"""
+
+    with _lock:
+        driver = _drivers.get((uri, user))
+        if driver is None:
+            driver = GraphDatabase.driver(uri, auth=(user, password), max_connection_pool_size=pool_size)
+            _drivers[(uri, user)] = driver
+    return driver
+
+@atexit.register
+def close_drivers():
+    with _lock:
+        for driver in _drivers.values():
+            driver.close()
+        _drivers.clear()
+
+def check_connectivity(uri=NEO4J_URL, user=NEO4J_USER, password=NEO4J_PASSWORD, ttl=HEALTH_TTL):
+    """Function that checks the connection to Neo4j without running any query.
+    The result is reused for ttl seconds"""
+
+    checked = _health.get((uri, user))
+    if checked is not None and time.monotonic() - checked[0] < ttl:
+        return checked[1]
+
+    try:
+        get_driver(uri, user, password).verify_connectivity()
+        connected = True
+    except Exception as e:
+        print(f"Connection failed: {e}")
+        connected = False
+    _health[(uri, user)] = (time.monotonic(), connected)
+    return connected
+
+def check_vector_index(uri, user, password, dimension, index_name='chunkVectorIndex'):
+    """Function that checks that the dimension of the vector index 
+    in Neo4j matches the dimension of the embedding model"""
+
+    try:
+        with get_driver(uri, user, password).session() as session:
+            record = session.run("SHOW INDEXES YIELD name, options WHERE name = $name RETURN options", name=index_name).single()
+    except Exception as e:
+        print(f"Connection failed: {e}")
+        return False
+
+    if record is None:
+        print(f"VECTOR INDEX {index_name} NOT FOUND")
+        return False
+    index_dimension = record["options"]["indexConfig"]["vector.dimensions"]
+    if index_dimension != dimension:
+        print(f"VECTOR INDEX {index_name} HAS DIMENSION {index_dimension} BUT THE EMBEDDING MODEL HAS DIMENSION {dimension}")
+        return False
+    return True
+
+def refresh_node_stats(uri=NEO4J_URL, user=NEO4J_USER, password=NEO4J_PASSWORD):
+    """Function that counts the nodes of each label in Neo4j.
+    Counts by label are answered by the count store without scanning the nodes"""
+
+    stats = {}
+    with get_driver(uri, user, password).session() as session:
+        labels = [record["label"] for record in session.run("CALL db.labels() YIELD label RETURN label")]
+        for label in labels:
+            stats[label] = session.run(f"MATCH (n:`{label}`) RETURN count(n) AS count").single()["count"]
+    _stats[(uri, user)] = (time.monotonic(), stats)
+    return stats
+
+def node_stats(uri=NEO4J_URL, user=NEO4J_USER, password=NEO4J_PASSWORD, ttl=STATS_TTL):
+    """Function that returns the number of nodes of each label,
+    counted again only when the cached counts are older than ttl seconds"""
+
+    cached = _stats.get((uri, user))
+    if cached is not None and time.monotonic() - cached[0] < ttl:
+        return cached[1]
+    return refresh_node_stats(uri, user, password)
+
+def start_stats_refresher(uri=NEO4J_URL, user=NEO4J_USER, password=NEO4J_PASSWORD, interval=STATS_TTL):
+    """Function that starts a background thread refreshing the node statistics
+    every interval seconds, so node_stats never waits for Neo4j"""
+
+    def refresh():
+        while True:
+            try:
+                refresh_node_stats(uri, user, password)
+            except Exception as e:
+                print(f"Node statistics refresh failed: {e}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=refresh, daemon=True)
+    thread.start()
+    return thread
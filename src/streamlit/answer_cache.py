@@ -0,0 +1,128 @@
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+import numpy as np
+
+ANSWER_CACHE_ENTRIES = 1000
+ANSWER_CACHE_TTL = 24 * 3600 #Seconds
+# Minimum cosine similarity between two questions to reuse an answer in the semantic tier
+SEMANTIC_THRESHOLD = 0.95
+# Seconds the version of a contract is reused before asking version_fn again
+VERSION_TTL = 60
+
+def normalize_question(question):
+    """Function that normalizes a question for the exact cache tier:
+    lowercase, without accents, punctuation or repeated spaces"""
+
+    question = unicodedata.normalize('NFKD', question.lower())
+    question = ''.join(c for c in question if not unicodedata.combining(c))
+    question = re.sub(r'[^\w\s]', ' ', question)
+    return ' '.join(question.split())
+
+def replay_answer(answer, callbacks):
+    """Function that sends a cached answer word by word to the callbacks
+    of the chain, so it is streamed like a new answer from the llm"""
+
+    for token in re.findall(r'\s*\S+', answer):
+        for callback in callbacks:
+            if hasattr(callback, 'on_llm_new_token'):
+                callback.on_llm_new_token(token)
+
+class AnswerCache:
+    """Answer cache keyed by (mode, contract, normalized question) with LRU eviction and TTL.
+    With embeddings, a question that misses the exact tier reuses the answer of a cached
+    question of the same mode and contract when their cosine similarity passes the threshold.
+    With version_fn, the answers of a contract are dropped when its version changes,
+    for example after the contract is ingested again"""
+
+    def __init__(self, max_entries=ANSWER_CACHE_ENTRIES, ttl=ANSWER_CACHE_TTL, embeddings=None,
+                 threshold=SEMANTIC_THRESHOLD, version_fn=None, version_ttl=VERSION_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.version_fn = version_fn
+        self.version_ttl = version_ttl
+        self.entries = OrderedDict()
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def version(self, contract):
+        if self.version_fn is None or not contract:
+            return None
+        checked = self.versions.get(contract)
+        if checked is None or time.monotonic() - checked[0] > self.version_ttl:
+            checked = (time.monotonic(), self.version_fn(contract))
+            self.versions[contract] = checked
+        return checked[1]
+
+    def embed(self, question):
+        vector = np.array(self.embeddings.embed_query(question), dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def lookup(self, mode, contract, question):
+        """Returns the cached answer of a question, or None, and the question vector
+        used by the semantic tier, so it can be reused when the answer is stored"""
+
+        key = (mode, contract, normalize_question(question))
+        version = self.version(contract)
+        now = time.monotonic()
+        with self.lock:
+            for cached_key in [k for k, entry in self.entries.items()
+                               if now - entry["created"] > self.ttl or (k[1] == contract and entry["version"] != version)]:
+                del self.entries[cached_key]
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry["answer"], entry["vector"]
+            candidates = [(k, entry) for k, entry in self.entries.items()
+                          if k[0] == mode and k[1] == contract and entry["vector"] is not None]
+
+        if self.embeddings is None:
+            return None, None
+        vector = self.embed(question)
+        if candidates:
+            scores = np.stack([entry["vector"] for _, entry in candidates]) @ vector
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                with self.lock:
+                    if candidates[best][0] in self.entries:
+                        self.entries.move_to_end(candidates[best][0])
+                return candidates[best][1]["answer"], vector
+        return None, vector
+
+    def put(self, mode, contract, question, answer, vector=None):
+        key = (mode, contract, normalize_question(question))
+        entry = {"answer": answer, "vector": vector, "version": self.version(contract), "created": time.monotonic()}
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, contract=None):
+        """Drops the cached answers of a contract, or every answer without contract"""
+
+        with self.lock:
+            for key in [k for k in self.entries if contract is None or k[1] == contract]:
+                del self.entries[key]
+            self.versions.pop(contract, None)
+
+def cached_chain(output_function, cache, mode, contract):
+    """Function that wraps the output function of llm_chain or qa_rag_chain with the answer cache.
+    Cached answers are streamed to the callbacks without calling the llm"""
+
+    def output(inputs, callbacks=None, **kwargs):
+        question = inputs["question"] if isinstance(inputs, dict) else inputs
+        answer, vector = cache.lookup(mode, contract, question)
+        if answer is not None:
+            replay_answer(answer, callbacks or [])
+            return {"answer": answer}
+
+        result = output_function(inputs, callbacks=callbacks, **kwargs)
+        if result.get("answer"):
+            cache.put(mode, contract, question, result["answer"], vector)
+        return result
+    return output
@@ -1,16 +1,23 @@
 from typing import List, Any
-from torch import cuda
-from langchain_openai import ChatOpenAI
 from langchain.prompts.chat import ChatPromptTemplate, SystemMessagePromptTemplate, HumanMessagePromptTemplate
 from langchain.chains.qa_with_sources import load_qa_with_sources_chain
-from langchain_community.vectorstores.neo4j_vector import Neo4jVector
 from langchain.chains.qa_with_sources.retrieval import RetrievalQAWithSourcesChain
-from langchain_community.embeddings.sentence_transformer import SentenceTransformerEmbeddings
 from utils import BaseLogger
 from connect_test import testnodes_neo4j
+from local_index import LocalVectorRetriever
+from lexical_index import HybridRetriever
+from retrievers import ContractRetriever, vector_index_query
+from context_packer import PackingRetriever, context_budget
+import os
 import sys
 sys.path.append('/Users/nfanlo/dev')
 from config.config import config
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from embedding_cache import CachedEmbeddings
+from embedding_batcher import BatchingEmbeddings
+from embedding_backend import EmbeddingBackend
+from neo4j_driver import get_driver, check_vector_index
+import instrumentation
 
 NEO4J_USER = "neo4j"
 NEO4J_DATABASE = "neo4j"
@@ -20,20 +27,36 @@ OPENAI_PASSWORD = config['openai_api_key']
 
 embed_model_id = 'sentence-transformers/all-MiniLM-L6-v2'
 
-device = f'cuda:{cuda.current_device()}' if cuda.is_available() else 'cpu'
+# Chunks retrieved for each question before packing them into the context budget of the model
+FETCH_K = 8
 
-def load_embedding(logger=BaseLogger()):
-    """Function that loads the selected embedding for later use in RAG mode"""
+# Engine of the embedding model: torch, int8 or onnx
+embed_engine = config.get('embedding_engine', 'torch')
+
+# ChatOpenAI, Neo4jVector and the embedding model (with torch) are imported
+# inside the functions that use them, so importing this module stays fast
 
-    embeddings = SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2")
-    dimension = 384
-    logger.info("Embedding: Using SentenceTransformer")
+def load_embedding(logger=BaseLogger()):
+    """Function that loads the selected embedding for later use in RAG mode. 
+    The query embeddings are looked up in the local embedding cache first and the
+    questions of concurrent sessions that miss the cache are encoded in one batch"""
+
+    backend = EmbeddingBackend(embed_model_id, embed_engine)
+    model = BatchingEmbeddings(backend,
+                               window=config.get("embedding_batch_window_ms", 5) / 1000,
+                               max_batch=config.get("embedding_max_batch", 32))
+    embeddings = CachedEmbeddings(model, backend.cache_id)
+    dimension = len(embeddings.embed_query("dimension"))
+    logger.info(f"Embedding: Using SentenceTransformer ({embed_engine})")
+    if not check_vector_index(NEO4J_URL, NEO4J_USER, NEO4J_PASSWORD, dimension):
+        logger.info("Embedding: dimension does not match the Neo4j vector index")
     return embeddings, dimension
 
 def load_llm(llm_name, logger=BaseLogger()):
     """Function that loads the selected model in the streamlit application. 
     The function waits for the input of the model name in str between gpt-3.5 or gpt-4"""
-    
+
+    from langchain_openai import ChatOpenAI
     if llm_name == 'gpt-4':
         logger.info('LLM: GPT-4')
         return ChatOpenAI(temperature=0.2, model_name='gpt-4', streaming=True, openai_api_key=OPENAI_PASSWORD)
@@ -62,38 +85,27 @@ def llm_chain(llm):
     chat_prompt = ChatPromptTemplate.from_messages([system_message_prompt, human_message_prompt])
 
     def llm_output(user_input: str, callbacks: List[Any], prompt=chat_prompt) -> str:
-        answer = llm(prompt.format_prompt(text=user_input).to_messages(), callbacks=callbacks).content
+        with instrumentation.span('chat_prompt', mode='llm'):
+            messages = prompt.format_prompt(text=user_input).to_messages()
+        answer = llm(messages, callbacks=callbacks).content
         return {"answer": answer}
     return llm_output
 
-def qa_rag_chain(llm, embeddings, embeddings_url, username, password, database, doc_name):
+def qa_rag_chain(llm, embeddings, embeddings_url, username, password, database, doc_name, local_index=None, lexical_index=None, lexical_prefilter=False):
     """Function that generates a response from the RAG system when the mode is activated. 
     The function expects the llm model, the embedding model, the contract name and the instance 
     variables from the Neo4j database. 
     The function will search the database for the chunks of text most similar to the user input 
-    and generate the complete response flow with the llm model"""
+    and generate the complete response flow with the llm model. 
+    When doc_name is given only the chunks of that contract are searched. 
+    If a local_index is passed the chunks are searched in the in-process vector index instead. 
+    If a lexical_index is passed its BM25 hits are fused with the vector hits, and with 
+    lexical_prefilter they are also the only candidates of the vector search. 
+    Both indexes can be passed as functions that return the current index"""
 
     testnodes_neo4j(NEO4J_URL, NEO4J_USER, NEO4J_PASSWORD, show_nodes=False)
     print("DOCUMENT NAME:", doc_name)
 
-    #Cypher query to retrieve chunk Neo4j contracts for user question
-    sample_query = """
-    WITH node AS doc, score AS similarity
-    ORDER BY similarity DESC LIMIT 5
-    CALL {
-        WITH doc
-        MATCH (e:Embedding)-[:HAS_EMBEDDING]->(chunk:Chunk)
-        OPTIONAL MATCH (chunk)-[:HAS_PARENT]->(section:Section)
-        OPTIONAL MATCH (section)-[:HAS_DOCUMENT]->(document:Document)
-        RETURN chunk AS result, section, document}
-    WITH result, section, document, similarity
-    RETURN 
-        result.sentences AS text,
-        similarity AS score,
-        {documentName: document.name,
-        sectionTitle: section.title,
-        pageIndex: result.page_idx} AS metadata
-    """
     #Template to generate QA with contracts retrieved from Neo4j
     general_system_template = """
     You are a GPT lawyer, the best specialist in contracts and Spanish laws.
@@ -118,23 +130,37 @@ def qa_rag_chain(llm, embeddings, embeddings_url, username, password, database,
 
     qa_chain = load_qa_with_sources_chain(llm, chain_type="stuff", prompt=qa_prompt)
 
-    graph_response = Neo4jVector.from_existing_index(
-        embedding=embeddings,
-        url=embeddings_url,
-        username=username,
-        password=password,
-        database=database,
-        index_name="chunkVectorIndex",
-        node_label="Embedding",
-        embedding_node_property="value",
-        text_node_property="sentences",
-        retrieval_query=sample_query)
+    if local_index is not None:
+        retriever = LocalVectorRetriever(index=local_index, embeddings=embeddings, k=FETCH_K, doc_name=doc_name or None)
+    elif doc_name:
+        retriever = ContractRetriever(driver=get_driver(embeddings_url, username, password), embeddings=embeddings, doc_name=doc_name, database=database, k=FETCH_K)
+    else:
+        from langchain_community.vectorstores.neo4j_vector import Neo4jVector
+        graph_response = Neo4jVector.from_existing_index(
+            embedding=embeddings,
+            url=embeddings_url,
+            username=username,
+            password=password,
+            database=database,
+            index_name="chunkVectorIndex",
+            node_label="Embedding",
+            embedding_node_property="value",
+            text_node_property="sentences",
+            retrieval_query=vector_index_query()) #Starts at the chunk of each hit and adds its neighbours
+        retriever = graph_response.as_retriever(search_kwargs={"k": FETCH_K})
+
+    if lexical_index is not None:
+        retriever = HybridRetriever(lexical=lexical_index, vector_retriever=retriever, k=FETCH_K, doc_name=doc_name or None,
+                                    prefilter=lexical_prefilter and hasattr(retriever, 'search_keys'))
+
+    # The retrieved chunks are deduplicated, merged and packed into the context budget of the model
+    model_name = getattr(llm, 'model_name', 'gpt-3.5-turbo')
+    retriever = PackingRetriever(retriever=retriever, model_name=model_name, budget=context_budget(model_name))
 
     graph_response_qa = RetrievalQAWithSourcesChain(
         combine_documents_chain=qa_chain,
-        retriever=graph_response.as_retriever(search_kwargs={"k": 2}), #Number of relevant chunks retrieved
-        reduce_k_below_max_tokens=True,
-        max_tokens_limit=3375, #GPT 3.5-turbo. Can be raised to 7000 for GPT 4
+        retriever=retriever,
+        reduce_k_below_max_tokens=False,
         return_source_documents=True)
     
     return graph_response_qa
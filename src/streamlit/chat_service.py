@@ -0,0 +1,303 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from aiohttp import web
+from langchain.callbacks.base import BaseCallbackHandler
+from utils import extract_title_and_question
+from stage_timer import StageTimer
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import instrumentation
+
+MAX_CONCURRENCY = 8 #Requests answered at the same time, the rest wait for a free slot
+QUEUE_TIMEOUT = 10 #Seconds a request waits for a free slot before answering 503
+REQUEST_TIMEOUT = 120 #Seconds to generate a complete answer
+MAX_CHAINS = 32 #Chains kept built, the least recently used one is dropped
+LLM_NAMES = ('gpt-3.5', 'gpt-4') #Accepted values of the llm field, the models of chains_rag.load_llm
+HOST = '0.0.0.0'
+PORT = 8080
+
+class RequestCancelled(Exception):
+    pass
+
+class QueueStreamHandler(BaseCallbackHandler):
+    """Callback handler that sends the tokens of the llm from the worker thread
+    to the asyncio queue of the request. Once the request is cancelled the next
+    token raises RequestCancelled, which stops the chain"""
+
+    # Without raise_error the callback manager only logs the exception and the llm goes on
+    raise_error = True
+
+    def __init__(self, loop, tokens):
+        self.loop = loop
+        self.tokens = tokens
+        self.cancelled = threading.Event()
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        if self.cancelled.is_set():
+            raise RequestCancelled()
+        self.loop.call_soon_threadsafe(self.tokens.put_nowait, token)
+
+class ChatService:
+    """Asyncio service with the chat (RAG on and off), ticket and health endpoints.
+    The backends are injected: llm_factory(llm_name) returns the chat model,
+    rag_chain_factory(llm, embeddings, contract_name) returns the RAG chain,
+    llm_chain_factory(llm) returns the chain without RAG, ticket_fn(question, llm)
+    drafts a ticket, health_fn() checks the graph backend and metrics_fn() returns
+    the statistics of the backends. Only the llm names in llm_names are accepted"""
+
+    def __init__(self, llm_factory, embeddings, llm_chain_factory, rag_chain_factory, ticket_fn, health_fn,
+                 metrics_fn=None, max_concurrency=MAX_CONCURRENCY, queue_timeout=QUEUE_TIMEOUT, request_timeout=REQUEST_TIMEOUT,
+                 llm_names=LLM_NAMES, max_chains=MAX_CHAINS):
+        self.llm_factory = llm_factory
+        self.embeddings = embeddings
+        self.llm_chain_factory = llm_chain_factory
+        self.rag_chain_factory = rag_chain_factory
+        self.ticket_fn = ticket_fn
+        self.health_fn = health_fn
+        self.metrics_fn = metrics_fn or dict
+        self.queue_timeout = queue_timeout
+        self.request_timeout = request_timeout
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.llm_names = llm_names
+        self.max_chains = max_chains
+        self.chains = OrderedDict()
+        self.chains_lock = threading.Lock()
+        self.inflight = 0
+
+    def chain(self, llm_name, contract_name=None):
+        """Returns the chain of a (llm name, contract name) pair, built only once while it
+        is among the max_chains most recently used. The chain is built outside the lock, so
+        a slow contract only makes wait the requests of the same pair. The chains keep no
+        state between requests: tokens go to the callbacks of each call"""
+
+        key = (llm_name, contract_name)
+        with self.chains_lock:
+            future = self.chains.get(key)
+            build = future is None
+            if build:
+                future = self.chains[key] = Future()
+            self.chains.move_to_end(key)
+            while len(self.chains) > self.max_chains:
+                self.chains.popitem(last=False)
+        if build:
+            try:
+                llm = self.llm_factory(llm_name)
+                if contract_name:
+                    future.set_result(self.rag_chain_factory(llm, self.embeddings, contract_name))
+                else:
+                    future.set_result(self.llm_chain_factory(llm))
+            except Exception as e:
+                future.set_exception(e)
+                # The next request of the pair tries to build it again
+                with self.chains_lock:
+                    if self.chains.get(key) is future:
+                        del self.chains[key]
+        return future.result()
+
+    async def read_body(self, request):
+        """Returns the json object of the request body, answering 400 to anything else"""
+
+        try:
+            body = await request.json()
+        except json.JSONDecodeError:
+            body = None
+        if not isinstance(body, dict):
+            raise web.HTTPBadRequest(text=json.dumps({"error": "the body must be a json object"}), content_type='application/json')
+        llm_name = body.get("llm", LLM_NAMES[0])
+        if llm_name not in self.llm_names:
+            raise web.HTTPBadRequest(text=json.dumps({"error": f"llm must be one of {', '.join(self.llm_names)}"}),
+                                     content_type='application/json')
+        return body
+
+    async def acquire_slot(self):
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise web.HTTPServiceUnavailable(text=json.dumps({"error": "too many requests"}), content_type='application/json')
+        self.inflight += 1
+
+    def release_slot(self):
+        self.inflight -= 1
+        self.slots.release()
+
+    async def health(self, request):
+        loop = asyncio.get_running_loop()
+        connected = await loop.run_in_executor(None, self.health_fn)
+        return web.json_response({"status": "ok" if connected else "unavailable",
+                                  "neo4j": connected,
+                                  "inflight": self.inflight},
+                                 status=200 if connected else 503)
+
+    async def metrics(self, request):
+        # metrics_fn may query the backends, so it does not run in the event loop
+        loop = asyncio.get_running_loop()
+        metrics = await loop.run_in_executor(None, self.metrics_fn)
+        return web.json_response({"inflight": self.inflight, **metrics})
+
+    async def prometheus_metrics(self, request):
+        """Returns the spans, counters and histograms of the instrumentation in the Prometheus text format"""
+
+        return web.Response(text=instrumentation.prometheus_text(), content_type='text/plain')
+
+    async def chat(self, request):
+        """Answers a question with server-sent events: one 'token' event per token
+        of the llm, then an 'answer' event with the complete answer or an 'error' event"""
+
+        body = await self.read_body(request)
+        question = body.get("question", "")
+        llm_name = body.get("llm", LLM_NAMES[0])
+        contract_name = body.get("contract") if body.get("rag") else None
+        if not question or (body.get("rag") and not contract_name):
+            raise web.HTTPBadRequest(text=json.dumps({"error": "question and contract (with rag) are required"}),
+                                     content_type='application/json')
+
+        mode = "rag" if contract_name else "llm"
+        instrumentation.count('chat_requests', mode=mode)
+        await self.acquire_slot()
+        result = None
+        try:
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+            await response.prepare(request)
+
+            loop = asyncio.get_running_loop()
+            tokens = asyncio.Queue()
+            handler = QueueStreamHandler(loop, tokens)
+            callbacks = [handler, StageTimer(mode)]
+
+            def run_chain():
+                try:
+                    chain = self.chain(llm_name, contract_name)
+                    with instrumentation.span('chat_total', mode=mode):
+                        if contract_name:
+                            return chain({"question": question, "input_text": question}, callbacks=callbacks)
+                        return chain(question, callbacks)
+                finally:
+                    loop.call_soon_threadsafe(tokens.put_nowait, None)
+
+            async def stream_tokens():
+                while True:
+                    token = await tokens.get()
+                    if token is None:
+                        break
+                    await send_event(response, "token", {"token": token})
+
+            result = loop.run_in_executor(self.executor, run_chain)
+            try:
+                await asyncio.wait_for(stream_tokens(), self.request_timeout)
+                answer = await asyncio.shield(result)
+                await send_event(response, "answer", {"answer": answer["answer"]})
+            except asyncio.TimeoutError:
+                handler.cancelled.set()
+                instrumentation.count('chat_errors', stage='timeout', mode=mode)
+                await send_event(response, "error", {"error": "timeout"})
+            except (asyncio.CancelledError, ConnectionResetError):
+                handler.cancelled.set()
+                instrumentation.count('chat_errors', stage='disconnect', mode=mode)
+                raise
+            except Exception as e:
+                handler.cancelled.set()
+                instrumentation.count('chat_errors', stage='chain', mode=mode)
+                await send_event(response, "error", {"error": str(e)})
+            await response.write_eof()
+            return response
+        finally:
+            # A cancelled chain stops at its next token: the slot is kept until the worker thread ends
+            if result is not None and not result.done():
+                result.add_done_callback(self.release_cancelled)
+            else:
+                self.release_slot()
+
+    def release_cancelled(self, result):
+        # The RequestCancelled of the chain was already answered with an 'error' event
+        if not result.cancelled():
+            result.exception()
+        self.release_slot()
+
+    async def ticket(self, request):
+        """Drafts an internal ticket from a question, answering its title and question"""
+
+        body = await self.read_body(request)
+        if not body.get("question"):
+            raise web.HTTPBadRequest(text=json.dumps({"error": "question is required"}), content_type='application/json')
+
+        await self.acquire_slot()
+        try:
+            loop = asyncio.get_running_loop()
+            llm = self.llm_factory(body.get("llm", LLM_NAMES[0]))
+
+            def run_ticket():
+                with instrumentation.span('ticket'):
+                    return self.ticket_fn(body["question"], llm)
+
+            try:
+                result = await asyncio.wait_for(loop.run_in_executor(self.executor, run_ticket), self.request_timeout)
+            except asyncio.TimeoutError:
+                raise web.HTTPGatewayTimeout(text=json.dumps({"error": "timeout"}), content_type='application/json')
+            title, question = extract_title_and_question(result["answer"])
+            return web.json_response({"title": title, "question": question})
+        finally:
+            self.release_slot()
+
+async def send_event(response, event, data):
+    await response.write(f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+def create_app(service):
+    app = web.Application()
+    app.router.add_get('/health', service.health)
+    app.router.add_get('/metrics', service.metrics)
+    app.router.add_get('/metrics/prometheus', service.prometheus_metrics)
+    app.router.add_post('/chat', service.chat)
+    app.router.add_post('/ticket', service.ticket)
+    return app
+
+def default_service(**kwargs):
+    """Function that builds the service with the OpenAI models,
+    the SentenceTransformer embedding and the Neo4j database"""
+
+    from chains_rag import (load_llm, load_embedding, llm_chain, qa_rag_chain, llm_ticket,
+                            NEO4J_URL, NEO4J_USER, NEO4J_PASSWORD, NEO4J_DATABASE)
+    from neo4j_driver import check_connectivity, node_stats, start_stats_refresher
+
+    embeddings, dimension = load_embedding()
+    # The node counts of /metrics are refreshed in the background, so the requests never wait for them
+    start_stats_refresher(NEO4J_URL, NEO4J_USER, NEO4J_PASSWORD)
+
+    def metrics():
+        try:
+            nodes = node_stats(NEO4J_URL, NEO4J_USER, NEO4J_PASSWORD)
+        except Exception as e:
+            nodes = {"error": str(e)}
+        return {"embedding_batches": embeddings.embeddings.metrics.snapshot(), "nodes": nodes}
+
+    def rag_chain_factory(llm, embeddings, contract_name):
+        return qa_rag_chain(llm, embeddings, doc_name=contract_name, embeddings_url=NEO4J_URL,
+                            username=NEO4J_USER, password=NEO4J_PASSWORD, database=NEO4J_DATABASE)
+
+    return ChatService(llm_factory=load_llm,
+                       embeddings=embeddings,
+                       llm_chain_factory=llm_chain,
+                       rag_chain_factory=rag_chain_factory,
+                       ticket_fn=llm_ticket,
+                       health_fn=lambda: check_connectivity(NEO4J_URL, NEO4J_USER, NEO4J_PASSWORD),
+                       metrics_fn=metrics,
+                       **kwargs)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='HTTP API with the chat, ticket and health endpoints')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--max-concurrency', type=int, default=MAX_CONCURRENCY)
+    parser.add_argument('--request-timeout', type=float, default=REQUEST_TIMEOUT)
+    args = parser.parse_args()
+
+    async def init_app():
+        # The service is created inside the event loop that serves it
+        return create_app(default_service(max_concurrency=args.max_concurrency, request_timeout=args.request_timeout))
+
+    web.run_app(init_app(), host=args.host, port=args.port)
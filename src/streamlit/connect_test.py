@@ -1,7 +1,9 @@
-from neo4j import GraphDatabase
+import os
 import sys
 sys.path.append('/Users/nfanlo/dev')
 from config.config import config
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from neo4j_driver import check_connectivity, node_stats
 
 #Change the following variables to your own Neo4j instance
 NEO4J_USER = "neo4j"
@@ -10,14 +12,19 @@ NEO4J_PASSWORD = config["neo4j_password"]
 NEO4J_URL = config["neo4j_url"]
 
 def testnodes_neo4j(uri, user, password, show_nodes=False):
-    try:
-        driver = GraphDatabase.driver(uri, auth=(user, password))
-        with driver.session() as session:
-            result = session.run("MATCH (n) RETURN count(n) AS count")
-            print("CONECTION TO NEO4J WORKS")
-            if show_nodes == True:
-                print("Number of nodes in the database:", result.single()["count"])
-    except Exception as e:
+    """Function that checks the connection to Neo4j with the shared driver.
+    The probe does not run any query and its result is cached for a few seconds. 
+    With show_nodes the cached number of nodes of each label is printed"""
+
+    if check_connectivity(uri, user, password):
+        print("CONECTION TO NEO4J WORKS")
+        if show_nodes == True:
+            stats = node_stats(uri, user, password)
+            print("Number of nodes in the database:", sum(stats.values()))
+            for label, count in stats.items():
+                print(f"{label}: {count}")
+    else:
         print("CONECTION TO NEO4J FAILED")
-        print(f"Connection failed: {e}")
-    driver.close()
\ No newline at end of file
+
+if __name__ == "__main__":
+    testnodes_neo4j(NEO4J_URL, NEO4J_USER, NEO4J_PASSWORD, show_nodes=True)
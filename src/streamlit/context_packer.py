@@ -0,0 +1,152 @@
+import os
+import re
+import sys
+import threading
+from typing import Any, List
+from langchain_core.documents import Document
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.retrievers import BaseRetriever
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import instrumentation
+
+# Tokens of context put in the prompt for each model
+CONTEXT_BUDGETS = {'gpt-4': 7000, 'gpt-3.5-turbo': 3375}
+DEFAULT_BUDGET = 3375
+# Tokens added by the stuff chain to each document ("Content: ...\nSource: ...")
+DOCUMENT_OVERHEAD = 12
+# Chunks of a section whose block_idx differ by at most this value are merged
+MAX_BLOCK_GAP = 1
+# Minimum word overlap (Jaccard) between two texts to keep only the best scored one
+DUPLICATE_THRESHOLD = 0.85
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+def get_encoding(model_name):
+    """Function that returns the tiktoken encoding of a model, loaded once per process"""
+
+    import tiktoken
+    with _encodings_lock:
+        if model_name not in _encodings:
+            try:
+                _encodings[model_name] = tiktoken.encoding_for_model(model_name)
+            except KeyError:
+                _encodings[model_name] = tiktoken.get_encoding('cl100k_base')
+        return _encodings[model_name]
+
+def context_budget(model_name):
+    for prefix, budget in CONTEXT_BUDGETS.items():
+        if model_name.startswith(prefix):
+            return budget
+    return DEFAULT_BUDGET
+
+def block_index(document):
+    """Function that returns the block_idx of a retrieved chunk, from its
+    metadata or from its key (doc_name + '_' + url_hash + '|' + block_idx + '|' + hash)"""
+
+    if document.metadata.get("blockIndex") is not None:
+        return int(document.metadata["blockIndex"])
+    key = document.metadata.get("key") or ""
+    parts = key.split('|')
+    return int(parts[1]) if len(parts) == 3 and parts[1].isdigit() else None
+
+def merge_adjacent(documents, max_gap=MAX_BLOCK_GAP):
+    """Function that merges the chunks of the same section whose block_idx are adjacent
+    into one document, in reading order and with the best score of the merged chunks"""
+
+    groups = {}
+    merged = []
+    for document in documents:
+        index = block_index(document)
+        section = (document.metadata.get("sectionKey") or document.metadata.get("sectionPath")
+                   or document.metadata.get("sectionTitle"))
+        if index is None or section is None:
+            merged.append(document)
+        else:
+            groups.setdefault((document.metadata.get("source"), section), []).append((index, document))
+
+    for chunks in groups.values():
+        chunks.sort(key=lambda chunk: chunk[0])
+        run = [chunks[0]]
+        for chunk in chunks[1:]:
+            if chunk[0] - run[-1][0] <= max_gap:
+                run.append(chunk)
+            else:
+                merged.append(merge_run(run))
+                run = [chunk]
+        merged.append(merge_run(run))
+    return merged
+
+def merge_run(run):
+    if len(run) == 1:
+        return run[0][1]
+    metadata = dict(run[0][1].metadata)
+    metadata["score"] = max(document.metadata.get("score", 0.0) for _, document in run)
+    metadata["blockIndex"] = run[0][0]
+    metadata["lastBlockIndex"] = run[-1][0]
+    # Hits expanded with their neighbouring chunks can repeat the end of the previous
+    # document at their start: only that overlap is dropped, repeated lines elsewhere are kept
+    lines = []
+    for _, document in run:
+        next_lines = document.page_content.split("\n")
+        lines.extend(next_lines[overlap(lines, next_lines):])
+    return Document(page_content="\n".join(lines), metadata=metadata)
+
+def overlap(lines, next_lines):
+    """Function that returns the number of lines at the start of next_lines that repeat the end of lines"""
+
+    for size in range(min(len(lines), len(next_lines)), 0, -1):
+        if lines[-size:] == next_lines[:size]:
+            return size
+    return 0
+
+def words(text):
+    return set(re.findall(r'\w+', text.lower()))
+
+def drop_near_duplicates(documents, threshold=DUPLICATE_THRESHOLD):
+    """Function that keeps only the best scored document of each group of texts
+    whose word overlap is over the threshold. Documents must be sorted by score"""
+
+    kept = []
+    for document in documents:
+        text_words = words(document.page_content)
+        duplicate = False
+        for _, kept_words in kept:
+            union = len(text_words | kept_words)
+            if union and len(text_words & kept_words) / union >= threshold:
+                duplicate = True
+                break
+        if not duplicate:
+            kept.append((document, text_words))
+    return [document for document, _ in kept]
+
+def pack_documents(documents, budget, model_name='gpt-3.5-turbo'):
+    """Function that packs the retrieved documents into the token budget of the prompt:
+    near-duplicates are dropped, adjacent chunks merged and the remaining documents
+    added by score while they fit in the budget"""
+
+    encoding = get_encoding(model_name)
+    by_score = lambda document: document.metadata.get("score", 0.0)
+    candidates = drop_near_duplicates(sorted(documents, key=by_score, reverse=True))
+    packed = []
+    used = 0
+    for document in sorted(merge_adjacent(candidates), key=by_score, reverse=True):
+        tokens = len(encoding.encode(document.page_content)) + DOCUMENT_OVERHEAD
+        if used + tokens <= budget:
+            packed.append(document)
+            used += tokens
+    return packed
+
+class PackingRetriever(BaseRetriever):
+    """Retriever that packs the documents of another retriever into the context
+    budget of the model. The wrapped retriever should return more candidates
+    than fit in the prompt, so the budget decides how many are used"""
+
+    retriever: Any
+    model_name: str = 'gpt-3.5-turbo'
+    budget: int = DEFAULT_BUDGET
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        documents = self.retriever.get_relevant_documents(query, callbacks=run_manager.get_child())
+        with instrumentation.span('context_pack'):
+            return pack_documents(documents, self.budget, self.model_name)
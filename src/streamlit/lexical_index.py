@@ -0,0 +1,315 @@
+import json
+import math
+import os
+import re
+import sys
+import threading
+import unicodedata
+from collections import Counter
+from typing import Any, List, Optional
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.retrievers import BaseRetriever
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from neo4j_driver import get_driver
+from local_index import current_index, refresh_index
+import instrumentation
+
+# Folder where the exported texts and the postings of the lexical index are stored
+INDEX_LOCATION = os.path.join(os.path.dirname(__file__), 'lexical-index')
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+# Constant of the reciprocal rank fusion: score = sum of 1 / (RRF_K + rank)
+RRF_K = 60
+# Minimum lexical hits to use them as the candidates of the vector search
+MIN_PREFILTER_HITS = 4
+
+STOPWORDS = set("""a al algo ante antes como con contra cual cuando de del desde donde durante e el ella ellos en entre
+era es esa ese eso esta este esto estos estas fue ha han hasta la las le les lo los mas me mi muy no nos o os para pero
+por que quien se sea segun ser si sin sobre su sus tambien te tiene todo tu un una uno unos y ya""".split())
+
+# Cypher query to export the nodes of a label created after the last exported one
+export_query = """
+MATCH (n:{label})
+WHERE id(n) > $last_id
+OPTIONAL MATCH (n)-[:HAS_PARENT]->(section:Section)
+RETURN id(n) AS id, n.key AS key, n.{property} AS text,
+       section.title AS sectionTitle, section.key AS sectionKey, n.page_idx AS pageIndex
+ORDER BY id ASC LIMIT $page_size
+"""
+
+# Cypher query to count the nodes of a label that the index should contain
+count_query = "MATCH (n:{label}) RETURN count(n) AS total"
+
+# Label and text property of the indexed nodes
+INDEXED_NODES = [("Chunk", "sentences"), ("Table", "name")]
+
+def tokenize(text):
+    """Function that splits a text into lowercase terms without accents.
+    Compound terms such as 14.2 or B-123/45 are kept whole and also split into their parts"""
+
+    text = unicodedata.normalize('NFKD', (text or "").lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    terms = []
+    for term in re.findall(r'[a-z0-9]+(?:[./-][a-z0-9]+)*', text):
+        parts = re.split(r'[./-]', term)
+        if len(parts) > 1:
+            terms.append(term)
+        terms.extend(part for part in parts if part not in STOPWORDS)
+    return terms
+
+class LexicalIndex:
+    """BM25 index over Chunk.sentences and Table.name of the Neo4j database.
+    The term counts of each node are appended to a jsonl file and the postings
+    are kept as compact numpy arrays (rows and term frequencies of each term)
+    in a npz file, where each refresh merges the postings of the new nodes"""
+
+    def __init__(self, location=INDEX_LOCATION):
+        self.location = location
+        self.documents_path = os.path.join(location, 'documents.jsonl')
+        self.postings_path = os.path.join(location, 'postings.npz')
+        self.vocabulary_path = os.path.join(location, 'vocabulary.json')
+        self.state_path = os.path.join(location, 'state.json')
+        self.lock = threading.Lock()
+        self.metadata = []
+        self.vocabulary = {}
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.rows = np.zeros(0, dtype=np.int32)
+        self.frequencies = np.zeros(0, dtype=np.float32)
+        self.lengths = np.zeros(0, dtype=np.float32)
+        self.doc_rows = {}
+        self.last_ids = {}
+        self.updated_at = -1
+        self.load()
+
+    def load(self):
+        """Loads the exported documents and the postings from disk. The postings of
+        the documents appended after the saved postings are merged into them, and
+        the postings are rebuilt when they have more rows than the exported documents"""
+
+        if os.path.exists(self.state_path):
+            with open(self.state_path, encoding='utf-8') as f:
+                self.updated_at = json.load(f)["updated_at"]
+        if not os.path.exists(self.documents_path):
+            return
+        with open(self.documents_path, encoding='utf-8') as f:
+            lines = [line for line in f if line.strip()]
+        documents = []
+        for line in lines:
+            try:
+                documents.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+        # A line cut by an interrupted refresh is dropped, so the next refresh appends after a complete row
+        if len(documents) < len(lines):
+            with open(self.documents_path, 'w', encoding='utf-8') as f:
+                f.writelines(lines[:len(documents)])
+        postings = None
+        if os.path.exists(self.postings_path) and os.path.exists(self.vocabulary_path):
+            postings = dict(np.load(self.postings_path))
+            if len(postings["lengths"]) > len(documents):
+                postings = None
+            else:
+                with open(self.vocabulary_path, encoding='utf-8') as f:
+                    postings["vocabulary"] = json.load(f)
+        if postings is None:
+            postings = {"vocabulary": {},
+                        "offsets": np.zeros(1, dtype=np.int64),
+                        "rows": np.zeros(0, dtype=np.int32),
+                        "frequencies": np.zeros(0, dtype=np.float32),
+                        "lengths": np.zeros(0, dtype=np.float32)}
+        if len(postings["lengths"]) < len(documents):
+            postings = self.add_postings(postings, documents[len(postings["lengths"]):])
+
+        # Rows of each document, so a search can be restricted to one contract
+        doc_rows = {}
+        for i, row in enumerate(documents):
+            doc_rows.setdefault(row["documentName"], []).append(i)
+        last_ids = {}
+        for row in documents:
+            last_ids[row["label"]] = max(last_ids.get(row["label"], -1), row["id"])
+        metadata = [{field: value for field, value in row.items() if field != "terms"} for row in documents]
+        with self.lock:
+            self.metadata = metadata
+            self.vocabulary = postings["vocabulary"]
+            self.offsets = postings["offsets"]
+            self.rows = postings["rows"]
+            self.frequencies = postings["frequencies"]
+            self.lengths = postings["lengths"]
+            self.doc_rows = {name: np.array(rows, dtype=np.int64) for name, rows in doc_rows.items()}
+            self.last_ids = last_ids
+
+    def add_postings(self, postings, documents):
+        """Merges the postings of the documents appended after the rows of the postings
+        and saves them to disk. Only the terms of the new documents are counted; the
+        existing entries are kept and sorted together with the new ones by term"""
+
+        start = len(postings["lengths"])
+        vocabulary = dict(postings["vocabulary"])
+        term_ids, rows, frequencies = [], [], []
+        for i, row in enumerate(documents, start):
+            for term, count in row["terms"].items():
+                term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+                rows.append(i)
+                frequencies.append(count)
+        # Term of each existing entry, then a stable sort keeps the rows of each term in order
+        terms = np.concatenate([np.repeat(np.arange(len(postings["offsets"]) - 1), np.diff(postings["offsets"])),
+                                np.array(term_ids, dtype=np.int64)])
+        order = np.argsort(terms, kind='stable')
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(terms, minlength=len(vocabulary)))
+        result = {"offsets": offsets,
+                  "rows": np.concatenate([postings["rows"], np.array(rows, dtype=np.int32)])[order],
+                  "frequencies": np.concatenate([postings["frequencies"], np.array(frequencies, dtype=np.float32)])[order],
+                  "lengths": np.concatenate([postings["lengths"],
+                                             np.array([sum(row["terms"].values()) for row in documents], dtype=np.float32)])}
+        np.savez(self.postings_path, **result)
+        with open(self.vocabulary_path, 'w', encoding='utf-8') as f:
+            json.dump(vocabulary, f, ensure_ascii=False)
+        result["vocabulary"] = vocabulary
+        return result
+
+    def clear(self):
+        for path in (self.documents_path, self.postings_path, self.vocabulary_path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
+        with self.lock:
+            self.metadata = []
+            self.lengths = np.zeros(0, dtype=np.float32)
+            self.doc_rows = {}
+            self.last_ids = {}
+            self.updated_at = -1
+
+    def refresh(self, driver, page_size=5000, rebuild=False):
+        """Exports the Chunk and Table nodes created since the last refresh and
+        appends them to the index (see refresh_index). Returns the number of new nodes"""
+
+        return refresh_index(self, driver, page_size, rebuild)
+
+    def database_total(self, session):
+        """Returns the number of Chunk and Table nodes that the index should contain"""
+
+        return sum(session.run(count_query.format(label=label)).single()["total"] for label, _ in INDEXED_NODES)
+
+    def export(self, session, page_size):
+        """Appends the Chunk and Table nodes created after the last exported ones to the index"""
+
+        count = 0
+        appended = False
+        try:
+            for label, property in INDEXED_NODES:
+                last_id = self.last_ids.get(label, -1)
+                while True:
+                    page = session.run(export_query.format(label=label, property=property),
+                                       last_id=last_id, page_size=page_size).data()
+                    if not page:
+                        break
+                    appended = True
+                    with open(self.documents_path, 'a', encoding='utf-8') as f:
+                        for row in page:
+                            row["label"] = label
+                            row["terms"] = Counter(tokenize(row["text"]))
+                            # Keys are doc_name + '_' + url_hash + '|' + block_idx + '|' + hash
+                            row["documentName"] = row["key"].split('|')[0].rsplit('_', 1)[0] if row["key"] else None
+                            f.write(json.dumps(row, ensure_ascii=False) + '\n')
+                    count += len(page)
+                    last_id = page[-1]["id"]
+        finally:
+            # The postings of the new rows are merged, and a line cut by an interrupted export is dropped
+            if appended:
+                self.load()
+        return count
+
+    def search(self, query, k=4, doc_name=None):
+        """Returns the k rows with the highest BM25 score for the query as (score, metadata) tuples.
+        With doc_name only the rows of that document are returned"""
+
+        with self.lock:
+            vocabulary, offsets, rows, frequencies = self.vocabulary, self.offsets, self.rows, self.frequencies
+            lengths, metadata, doc_rows = self.lengths, self.metadata, self.doc_rows
+        if not len(lengths):
+            return []
+
+        scores = np.zeros(len(lengths), dtype=np.float32)
+        norm = K1 * (1 - B + B * lengths / max(float(lengths.mean()), 1e-9))
+        for term in set(tokenize(query)):
+            term_id = vocabulary.get(term)
+            if term_id is None:
+                continue
+            term_rows = rows[offsets[term_id]:offsets[term_id + 1]]
+            tf = frequencies[offsets[term_id]:offsets[term_id + 1]]
+            idf = math.log(1 + (len(lengths) - len(term_rows) + 0.5) / (len(term_rows) + 0.5))
+            scores[term_rows] += idf * tf * (K1 + 1) / (tf + norm[term_rows])
+
+        if doc_name is not None:
+            candidates = doc_rows.get(doc_name)
+            if candidates is None:
+                return []
+        else:
+            candidates = np.arange(len(scores))
+        candidates = candidates[scores[candidates] > 0]
+        if not len(candidates):
+            return []
+        k = min(k, len(candidates))
+        top = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), metadata[i]) for i in top]
+
+def row_document(score, row):
+    return Document(page_content=row["text"] or "",
+                    metadata={"documentName": row["documentName"],
+                              "sectionTitle": row["sectionTitle"],
+                              "sectionKey": row["sectionKey"],
+                              "pageIndex": row["pageIndex"],
+                              "key": row["key"],
+                              "score": score,
+                              "source": row["documentName"]})
+
+class HybridRetriever(BaseRetriever):
+    """Retriever that combines the BM25 hits of a LexicalIndex with the hits of a
+    vector retriever by reciprocal rank fusion. With prefilter, the lexical hits are
+    the only candidates scored by the vector retriever (through its search_keys method),
+    unless there are fewer than MIN_PREFILTER_HITS of them. lexical can also be a
+    function that returns the current index, as the index of LocalVectorRetriever"""
+
+    lexical: Any
+    vector_retriever: Any
+    k: int = 4
+    doc_name: Optional[str] = None
+    prefilter: bool = False
+    rrf_k: int = RRF_K
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        # With prefilter a single search returns the candidates, and its top k are the lexical hits
+        with instrumentation.span('lexical_search'):
+            hits = current_index(self.lexical).search(query, self.k * 8 if self.prefilter else self.k, self.doc_name)
+            lexical_documents = [row_document(score, row) for score, row in hits[:self.k]]
+        if self.prefilter and len(lexical_documents) >= MIN_PREFILTER_HITS:
+            vector_documents = self.vector_retriever.search_keys(query, [row["key"] for _, row in hits], self.k)
+        else:
+            vector_documents = self.vector_retriever.get_relevant_documents(query, callbacks=run_manager.get_child())
+
+        fused = {}
+        for documents in (vector_documents, lexical_documents):
+            for rank, document in enumerate(documents):
+                key = document.metadata.get("key") or document.page_content
+                if key not in fused:
+                    fused[key] = (0.0, document)
+                fused[key] = (fused[key][0] + 1 / (self.rrf_k + rank + 1), fused[key][1])
+
+        documents = []
+        for score, document in sorted(fused.values(), key=lambda item: item[0], reverse=True)[:self.k]:
+            documents.append(Document(page_content=document.page_content,
+                                      metadata={**document.metadata, "score": score}))
+        return documents
+
+def load_lexical_index(url, username, password):
+    """Function that loads the lexical index and refreshes it with the
+    Chunk and Table nodes created in the Neo4j database since the last refresh"""
+
+    index = LexicalIndex()
+    print(f"LEXICAL INDEX: {index.refresh(get_driver(url, username, password))} NEW NODES")
+    return index
@@ -0,0 +1,258 @@
+import json
+import os
+import sys
+import threading
+from typing import Any, List, Optional
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.retrievers import BaseRetriever
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from neo4j_driver import get_driver
+import instrumentation
+
+# Folder where the exported Embedding vectors and their metadata are stored
+INDEX_LOCATION = os.path.join(os.path.dirname(__file__), 'vector-index')
+
+# Cypher query to export the Embedding nodes created after the last exported one
+export_query = """
+MATCH (chunk)-[:HAS_EMBEDDING]->(e:Embedding)
+WHERE id(e) > $last_id
+OPTIONAL MATCH (chunk)-[:HAS_PARENT]->(section:Section)
+RETURN id(e) AS id, e.value AS value, chunk.key AS key,
+       coalesce(chunk.sentences, chunk.name) AS text,
+       section.title AS sectionTitle, section.key AS sectionKey, chunk.page_idx AS pageIndex
+ORDER BY id ASC LIMIT $page_size
+"""
+
+# Cypher query to find the documents written since the last refresh, whose nodes may have
+# been deleted or renamed by the incremental ingestion, and the time of the database
+updated_documents_query = """
+OPTIONAL MATCH (d:Document) WHERE d.updated_at > $since
+RETURN timestamp() AS now, collect(d.name) AS names
+"""
+
+# Cypher query to count the Embedding nodes that the index should contain
+count_query = "MATCH ()-[:HAS_EMBEDDING]->(e:Embedding) RETURN count(e) AS total"
+
+class LocalVectorIndex:
+    """In-process vector index with the Embedding nodes of the Neo4j database.
+    The vectors are kept normalized in a memory-mapped float32 matrix and searched
+    with an exact cosine top-k. The metadata of each row is kept in a jsonl file"""
+
+    def __init__(self, dimension=384, location=INDEX_LOCATION):
+        self.dimension = dimension
+        self.location = location
+        self.vectors_path = os.path.join(location, 'vectors.f32')
+        self.metadata_path = os.path.join(location, 'metadata.jsonl')
+        self.state_path = os.path.join(location, 'state.json')
+        self.lock = threading.Lock()
+        self.metadata = []
+        self.matrix = np.zeros((0, dimension), dtype=np.float32)
+        self.doc_rows = {}
+        self.key_rows = {}
+        self.last_id = -1
+        self.updated_at = -1
+        self.load()
+
+    def load(self):
+        """Loads the exported vectors and metadata from disk"""
+
+        if os.path.exists(self.state_path):
+            with open(self.state_path, encoding='utf-8') as f:
+                self.updated_at = json.load(f)["updated_at"]
+        if not os.path.exists(self.metadata_path):
+            return
+        with open(self.metadata_path, encoding='utf-8') as f:
+            lines = f.readlines()
+        metadata = []
+        for line in lines:
+            try:
+                metadata.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+        # An interrupted refresh leaves vectors without metadata (or a cut metadata line):
+        # both files are cut to the rows they have in common, so the next refresh appends aligned rows
+        row_size = 4 * self.dimension
+        vectors_size = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+        aligned = min(len(metadata), vectors_size // row_size)
+        if aligned < len(lines):
+            metadata = metadata[:aligned]
+            with open(self.metadata_path, 'w', encoding='utf-8') as f:
+                f.writelines(json.dumps(row, ensure_ascii=False) + '\n' for row in metadata)
+        if vectors_size != aligned * row_size:
+            with open(self.vectors_path, 'r+b') as f:
+                f.truncate(aligned * row_size)
+        matrix = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(len(metadata), self.dimension)) if metadata else self.matrix
+        # Rows of each document, so a search can be restricted to one contract
+        doc_rows = {}
+        for i, row in enumerate(metadata):
+            doc_rows.setdefault(row["documentName"], []).append(i)
+        doc_rows = {name: np.array(rows, dtype=np.int64) for name, rows in doc_rows.items()}
+        key_rows = {row["key"]: i for i, row in enumerate(metadata)}
+        with self.lock:
+            self.metadata = metadata
+            self.matrix = matrix
+            self.doc_rows = doc_rows
+            self.key_rows = key_rows
+            self.last_id = max((row["id"] for row in metadata), default=-1)
+
+    def clear(self):
+        for path in (self.vectors_path, self.metadata_path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
+        with self.lock:
+            self.metadata = []
+            self.matrix = np.zeros((0, self.dimension), dtype=np.float32)
+            self.doc_rows = {}
+            self.key_rows = {}
+            self.last_id = -1
+            self.updated_at = -1
+
+    def refresh(self, driver, page_size=5000, rebuild=False):
+        """Exports the Embedding nodes created since the last refresh and appends
+        them to the index (see refresh_index). Returns the number of new vectors"""
+
+        return refresh_index(self, driver, page_size, rebuild)
+
+    def database_total(self, session):
+        """Returns the number of Embedding nodes that the index should contain"""
+
+        return session.run(count_query).single()["total"]
+
+    def export(self, session, page_size):
+        """Appends the Embedding nodes created after the last exported one to the index"""
+
+        count = 0
+        last_id = self.last_id
+        appended = False
+        try:
+            while True:
+                page = session.run(export_query, last_id=last_id, page_size=page_size).data()
+                if not page:
+                    break
+                vectors = np.array([json.loads(row["value"]) if isinstance(row["value"], str) else row["value"]
+                                    for row in page], dtype=np.float32)
+                vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+                appended = True
+                with open(self.vectors_path, 'ab') as f:
+                    f.write(vectors.tobytes())
+                with open(self.metadata_path, 'a', encoding='utf-8') as f:
+                    for row in page:
+                        row.pop("value")
+                        # Keys are doc_name + '_' + url_hash + '|' + block_idx + '|' + hash
+                        row["documentName"] = row["key"].split('|')[0].rsplit('_', 1)[0] if row["key"] else None
+                        f.write(json.dumps(row, ensure_ascii=False) + '\n')
+                count += len(page)
+                last_id = page[-1]["id"]
+        finally:
+            # The files are realigned if the export was interrupted
+            if appended:
+                self.load()
+        return count
+
+    def search(self, query_vector, k=4, doc_name=None, keys=None):
+        """Returns the k rows most similar to the query vector as (score, metadata) tuples.
+        With doc_name only the rows of that document are scored and with keys only
+        the rows of those chunks"""
+
+        with self.lock:
+            matrix, metadata, doc_rows, key_rows = self.matrix, self.metadata, self.doc_rows, self.key_rows
+        if keys is not None:
+            rows = np.array([key_rows[key] for key in keys if key in key_rows], dtype=np.int64)
+            matrix = matrix[rows]
+        elif doc_name is not None:
+            rows = doc_rows.get(doc_name)
+            if rows is None:
+                return []
+            matrix = matrix[rows]
+        else:
+            rows = None
+        if not len(matrix):
+            return []
+
+        query = np.array(query_vector, dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        scores = matrix @ query
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        if rows is not None:
+            return [(float(scores[i]), metadata[rows[i]]) for i in top]
+        return [(float(scores[i]), metadata[i]) for i in top]
+
+def refresh_index(index, driver, page_size=5000, rebuild=False):
+    """Function that refreshes a LocalVectorIndex or a LexicalIndex with the nodes
+    created since its last refresh. The incremental ingestion deletes and renames nodes,
+    and Neo4j reuses the ids of the deleted ones, so the index is exported again from
+    scratch when a document already in the index was written since the last refresh
+    or when the rows do not match the nodes of the database after the export, as well
+    as with rebuild. Returns the number of exported nodes"""
+
+    os.makedirs(index.location, exist_ok=True)
+    with driver.session() as session:
+        updated = session.run(updated_documents_query, since=index.updated_at).single()
+        if rebuild or set(updated["names"]) & index.doc_rows.keys():
+            rebuild = True
+            index.clear()
+        count = index.export(session, page_size)
+        if not rebuild and index.database_total(session) != len(index.metadata):
+            index.clear()
+            count = index.export(session, page_size)
+    index.updated_at = updated["now"]
+    tmp_path = index.state_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"updated_at": index.updated_at}, f)
+    os.replace(tmp_path, index.state_path)
+    return count
+
+def current_index(index):
+    return index() if callable(index) else index
+
+class LocalVectorRetriever(BaseRetriever):
+    """Retriever over a LocalVectorIndex for RetrievalQAWithSourcesChain.
+    index can also be a function that returns the current index, so a cached
+    chain searches the index refreshed after the chain was built"""
+
+    index: Any
+    embeddings: Any
+    k: int = 4
+    doc_name: Optional[str] = None
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        with instrumentation.span('embed_query'):
+            embedding = self.embeddings.embed_query(query)
+        with instrumentation.span('vector_search', retriever='local'):
+            results = current_index(self.index).search(embedding, self.k, self.doc_name)
+        return self.documents(results)
+
+    def search_keys(self, query: str, keys: List[str], k: int) -> List[Document]:
+        """Scores only the chunks with the given keys, used when
+        the candidates are narrowed first by the lexical index"""
+
+        with instrumentation.span('embed_query'):
+            embedding = self.embeddings.embed_query(query)
+        with instrumentation.span('vector_search', retriever='local_keys'):
+            results = current_index(self.index).search(embedding, k, keys=keys)
+        return self.documents(results)
+
+    def documents(self, results):
+        documents = []
+        for score, row in results:
+            documents.append(Document(page_content=row["text"] or "",
+                                      metadata={"documentName": row["documentName"],
+                                                "sectionTitle": row["sectionTitle"],
+                                                "sectionKey": row.get("sectionKey"),
+                                                "pageIndex": row["pageIndex"],
+                                                "key": row["key"],
+                                                "score": score,
+                                                "source": row["documentName"]}))
+        return documents
+
+def load_local_index(url, username, password, dimension=384):
+    """Function that loads the local vector index and refreshes it with the
+    embeddings created in the Neo4j database since the last refresh"""
+
+    index = LocalVectorIndex(dimension)
+    print(f"LOCAL VECTOR INDEX: {index.refresh(get_driver(url, username, password))} NEW EMBEDDINGS")
+    return index
@@ -0,0 +1,117 @@
+import argparse
+import json
+import os
+from datetime import datetime
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from answer_cache import normalize_question
+from report_log import REPORTS_LOCATION, rag_reports, ticket_reports
+
+# Parquet datasets partitioned by date and document, one folder per report
+ANALYTICS_LOCATION = os.path.join(REPORTS_LOCATION, 'analytics')
+STATE_PATH = os.path.join(ANALYTICS_LOCATION, 'compaction-state.json')
+NO_DOCUMENT = '_none'
+
+partitioning = ds.partitioning(pa.schema([('date', pa.string()), ('document', pa.string())]), flavor='hive')
+
+def read_new_records(log, offset):
+    """Function that reads the complete records appended to a report log after offset.
+    Returns the records and the offset of the end of the last record read"""
+
+    log.flush()
+    if not os.path.exists(log.path):
+        return [], offset
+    with open(log.path, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b'\n') + 1
+    records = [json.loads(line) for line in data[:end].decode('utf-8').splitlines() if line.strip()]
+    return records, offset + end
+
+def compact(name, log, state):
+    """Function that appends the new records of a report log to its parquet dataset"""
+
+    records, offset = read_new_records(log, state.get(name, 0))
+    if records:
+        df = pd.DataFrame(records, columns=log.fields).fillna('')
+        df['date'] = df['Date'].str[:10]
+        df['document'] = df['Document'].replace('', NO_DOCUMENT)
+        if name == 'rag-reports':
+            df['rag'] = df['Assistant_rag_chain'] != ''
+        stamp = datetime.now().strftime('%Y%m%d%H%M%S%f')
+        pq.write_to_dataset(pa.Table.from_pandas(df, preserve_index=False),
+                            os.path.join(ANALYTICS_LOCATION, name),
+                            partitioning=partitioning,
+                            basename_template=f'part-{stamp}-{{i}}.parquet',
+                            existing_data_behavior='overwrite_or_ignore')
+    state[name] = offset
+    return len(records)
+
+def compact_reports():
+    """Function that rolls the rag and ticket report logs into the partitioned parquet datasets.
+    Only the records appended since the last compaction are read"""
+
+    os.makedirs(ANALYTICS_LOCATION, exist_ok=True)
+    state = {}
+    if os.path.exists(STATE_PATH):
+        with open(STATE_PATH) as f:
+            state = json.load(f)
+    counts = {'rag-reports': compact('rag-reports', rag_reports, state),
+              'ticket-reports': compact('ticket-reports', ticket_reports, state)}
+    with open(STATE_PATH, 'w') as f:
+        json.dump(state, f)
+    return counts
+
+def read_reports(name, columns, start=None, end=None, document=None):
+    """Function that reads only the given columns of the partitions of a report
+    between the start and end dates (YYYY-MM-DD, both included) and of one document"""
+
+    path = os.path.join(ANALYTICS_LOCATION, name)
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=columns)
+    dataset = ds.dataset(path, format='parquet', partitioning=partitioning)
+    condition = None
+    for expression in [ds.field('date') >= start if start else None,
+                       ds.field('date') <= end if end else None,
+                       ds.field('document') == document if document else None]:
+        if expression is not None:
+            condition = expression if condition is None else condition & expression
+    return dataset.to_table(columns=columns, filter=condition).to_pandas()
+
+def questions_per_contract_per_day(start=None, end=None):
+    df = read_reports('rag-reports', ['date', 'document'], start, end)
+    return df.groupby(['document', 'date']).size().rename('questions').reset_index()
+
+def rag_usage(start=None, end=None):
+    df = read_reports('rag-reports', ['date', 'rag'], start, end)
+    return df.groupby(['date', 'rag']).size().rename('questions').reset_index()
+
+def ticket_rate_per_document(start=None, end=None):
+    questions = read_reports('rag-reports', ['document'], start, end).groupby('document').size().rename('questions')
+    tickets = read_reports('ticket-reports', ['document'], start, end).groupby('document').size().rename('tickets')
+    df = pd.concat([questions, tickets], axis=1).fillna(0).astype(int)
+    df['ticket_rate'] = df['tickets'] / df['questions'].where(df['questions'] > 0)
+    return df.rename_axis('document').reset_index()
+
+def top_questions(n=10, start=None, end=None, document=None):
+    df = read_reports('rag-reports', ['User_Input'], start, end, document)
+    questions = df['User_Input'].astype(str).map(normalize_question)
+    return questions.value_counts().head(n).rename_axis('question').rename('count').reset_index()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compact the report logs into parquet and print the usage rollups')
+    parser.add_argument('--start', help='first date included, YYYY-MM-DD')
+    parser.add_argument('--end', help='last date included, YYYY-MM-DD')
+    args = parser.parse_args()
+
+    print(f'COMPACTED RECORDS: {compact_reports()}')
+    print('-----------------------------------------------------------------')
+    print(questions_per_contract_per_day(args.start, args.end).to_string(index=False))
+    print('-----------------------------------------------------------------')
+    print(rag_usage(args.start, args.end).to_string(index=False))
+    print('-----------------------------------------------------------------')
+    print(ticket_rate_per_document(args.start, args.end).to_string(index=False))
+    print('-----------------------------------------------------------------')
+    print(top_questions(10, args.start, args.end).to_string(index=False))
@@ -0,0 +1,148 @@
+import argparse
+import atexit
+import csv
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import instrumentation
+
+REPORTS_LOCATION = os.path.join(os.path.dirname(__file__), 'dashboard-data')
+
+# Fixed schema of each report, in the column order of the exported csv files
+RAG_REPORT_FIELDS = ['Date', 'Document', 'User_Input', 'Assistant_llm_chain', 'Assistant_rag_chain', 'User']
+TICKET_REPORT_FIELDS = ['Date', 'User', 'Document', 'Original_title_question', 'New_title_question', 'New_user_question']
+
+FLUSH_INTERVAL = 1.0 #Seconds the writer waits for more records before writing a batch
+FLUSH_SIZE = 100 #Maximum records written in each batch
+FLUSH_TIMEOUT = 10.0 #Seconds flush waits for the writer before giving up
+
+class ReportLog:
+    """Append-only jsonl log of report records with a fixed schema.
+    log() only puts the record in a queue; a background thread appends the
+    records to the file in batches, so the cost per record does not depend
+    on the size of the log"""
+
+    def __init__(self, path, fields, flush_interval=FLUSH_INTERVAL, flush_size=FLUSH_SIZE):
+        self.path = path
+        self.fields = fields
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.records = queue.Queue()
+        self.writer = None
+        self.lock = threading.Lock()
+
+    def log(self, **record):
+        """Queues a record. Missing fields are left empty and Date defaults to now"""
+
+        row = {field: record.get(field, "") for field in self.fields}
+        if not row.get("Date"):
+            row["Date"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.lock:
+            if self.writer is None or not self.writer.is_alive():
+                self.writer = threading.Thread(target=self.write, daemon=True)
+                self.writer.start()
+        self.records.put(row)
+
+    def write(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            while True:
+                batch = [self.records.get()]
+                deadline = time.monotonic() + self.flush_interval
+                try:
+                    while len(batch) < self.flush_size:
+                        batch.append(self.records.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    pass
+                with instrumentation.span('report_write', report=os.path.basename(self.path)):
+                    f.write(''.join(json.dumps(row, ensure_ascii=False, default=str) + '\n' for row in batch))
+                    f.flush()
+                for _ in batch:
+                    self.records.task_done()
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        """Waits until every queued record is written. Returns False when the
+        writer thread has stopped or the records are not written within timeout seconds"""
+
+        if self.writer is None:
+            return True
+        deadline = time.monotonic() + timeout
+        with self.records.all_tasks_done:
+            while self.records.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if not self.writer.is_alive() or remaining <= 0:
+                    print(f'REPORT LOG {self.path}: {self.records.unfinished_tasks} RECORDS NOT WRITTEN')
+                    return False
+                self.records.all_tasks_done.wait(min(remaining, 0.1))
+        return True
+
+    def read(self):
+        self.flush()
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, encoding='utf-8') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def export_csv(self, csv_path):
+        """Writes the log to a csv file with an Index column and the fields of the schema"""
+
+        with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=['Index'] + self.fields, extrasaction='ignore')
+            writer.writeheader()
+            for index, row in enumerate(self.read(), start=1):
+                writer.writerow({'Index': index, **row})
+
+    def import_csv(self, csv_path, renamed_fields=None):
+        """Appends the rows of a csv report written by previous versions to the log.
+        renamed_fields maps old column names to fields of the schema. Rows already
+        in the log are skipped (a row repeated n times is only added while the log
+        has fewer than n copies), so importing the same file again, or a csv exported
+        from the log, adds nothing. Returns the number of rows added"""
+
+        if not os.path.exists(csv_path):
+            return 0
+        renamed_fields = renamed_fields or {}
+        stored = Counter(tuple(str(row.get(field) or "") for field in self.fields) for row in self.read())
+        count = 0
+        with open(csv_path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                for old_field, field in renamed_fields.items():
+                    if row.get(old_field) and not row.get(field):
+                        row[field] = row[old_field]
+                record = {field: row.get(field) or "" for field in self.fields}
+                key = tuple(str(record[field]) for field in self.fields)
+                if stored[key]:
+                    stored[key] -= 1
+                    continue
+                self.log(**record)
+                count += 1
+        self.flush()
+        return count
+
+rag_reports = ReportLog(os.path.join(REPORTS_LOCATION, 'rag-reports.jsonl'), RAG_REPORT_FIELDS)
+ticket_reports = ReportLog(os.path.join(REPORTS_LOCATION, 'ticket-reports.jsonl'), TICKET_REPORT_FIELDS)
+
+@atexit.register
+def flush_reports():
+    rag_reports.flush()
+    ticket_reports.flush()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export the report logs to the csv files of dashboard-data')
+    args = parser.parse_args()
+
+    rag_csv = os.path.join(REPORTS_LOCATION, 'rag-reports.csv')
+    ticket_csv = os.path.join(REPORTS_LOCATION, 'ticket-reports.csv')
+    # The rows of the csv files that are not in the logs yet (the reports of previous
+    # versions) are imported before the files are written again, so no row is lost
+    imported = rag_reports.import_csv(rag_csv, {'Usuario': 'User'}) + ticket_reports.import_csv(ticket_csv)
+    print(f'IMPORTED {imported} ROWS FROM THE CSV FILES')
+    rag_reports.export_csv(rag_csv)
+    ticket_reports.export_csv(ticket_csv)
+    print(f'EXPORTED {rag_csv} AND {ticket_csv}')
@@ -0,0 +1,113 @@
+import os
+import sys
+from typing import Any, List
+from langchain_core.documents import Document
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.retrievers import BaseRetriever
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import instrumentation
+
+#Neighbouring chunks of the same section added on each side of a hit
+NEIGHBOUR_WINDOW = 1
+
+#Cypher fragment that expands each (chunk, score) hit with the chunks of the same section
+#within $window blocks, found by the (doc_url_hash, block_idx) index, in the same round trip.
+#The document and the section path are read from the properties stored at ingestion
+expand_hits = """
+CALL {
+    WITH chunk
+    OPTIONAL MATCH (n:Chunk {doc_url_hash: chunk.doc_url_hash})
+    WHERE n.block_idx >= chunk.block_idx - $window AND n.block_idx <= chunk.block_idx + $window
+      AND n <> chunk AND n.section_path = chunk.section_path
+    WITH n ORDER BY n.block_idx
+    RETURN collect(n) AS neighbours}
+WITH chunk, score,
+    [n IN neighbours WHERE n.block_idx < chunk.block_idx | n.sentences] +
+    [coalesce(chunk.sentences, chunk.name)] +
+    [n IN neighbours WHERE n.block_idx > chunk.block_idx | n.sentences] AS texts
+RETURN
+    reduce(text = head(texts), t IN tail(texts) | text + '\\n' + t) AS text,
+    score,
+    {documentName: chunk.doc_name,
+    sectionPath: chunk.section_path,
+    sectionTitle: CASE chunk.section_path WHEN '' THEN null ELSE last(split(chunk.section_path, ' > ')) END,
+    pageIndex: chunk.page_idx,
+    blockIndex: chunk.block_idx,
+    key: chunk.key,
+    source: chunk.doc_name} AS metadata
+"""
+
+#Cypher query to score only the chunks of one contract against the question embedding.
+#The key prefix of its chunks is read from the Document in each query, so a contract
+#ingested again under another url_hash is found without building the retriever again
+contract_query = """
+MATCH (d:Document {name: $doc_name})
+WITH d.name + '_' + d.url_hash + '|' AS prefix
+MATCH (chunk:Chunk) WHERE chunk.key STARTS WITH prefix
+MATCH (chunk)-[:HAS_EMBEDDING]->(e:Embedding)
+WITH chunk, vector.similarity.cosine(e.value, $embedding) AS score
+ORDER BY score DESC LIMIT $k
+""" + expand_hits
+
+#Cypher query to score only the given chunks and tables against the question embedding
+keys_query = """
+UNWIND $keys AS key
+CALL {
+    WITH key MATCH (c:Chunk {key: key}) RETURN c AS chunk
+    UNION
+    WITH key MATCH (t:Table {key: key}) RETURN t AS chunk}
+MATCH (chunk)-[:HAS_EMBEDDING]->(e:Embedding)
+WITH chunk, vector.similarity.cosine(e.value, $embedding) AS score
+ORDER BY score DESC LIMIT $k
+""" + expand_hits
+
+def vector_index_query(window=NEIGHBOUR_WINDOW):
+    """Function that returns the retrieval query of Neo4jVector over the Embedding vector index.
+    It starts at the chunk of each Embedding hit; the window is written in the query
+    because Neo4jVector does not pass extra parameters"""
+
+    return """
+    WITH node AS e, score
+    MATCH (chunk)-[:HAS_EMBEDDING]->(e)
+    """ + expand_hits.replace('$window', str(int(window)))
+
+class ContractRetriever(BaseRetriever):
+    """Retriever that searches only the chunks of one contract in Neo4j.
+    The candidates are the chunks whose key starts with the key prefix of the
+    contract Document, so the cost of each search grows with the size of the
+    contract and not with the size of the database"""
+
+    driver: Any
+    embeddings: Any
+    doc_name: str
+    database: str = "neo4j"
+    k: int = 4
+    window: int = NEIGHBOUR_WINDOW
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        with instrumentation.span('embed_query'):
+            embedding = self.embeddings.embed_query(query)
+        with instrumentation.span('vector_search', retriever='contract'):
+            with self.driver.session(database=self.database) as session:
+                records = session.run(contract_query, doc_name=self.doc_name, embedding=embedding,
+                                      k=self.k, window=self.window).data()
+        return self.documents(records)
+
+    def search_keys(self, query: str, keys: List[str], k: int) -> List[Document]:
+        """Scores only the chunks and tables with the given keys, used when
+        the candidates are narrowed first by the lexical index"""
+
+        if not keys:
+            return []
+        with instrumentation.span('embed_query'):
+            embedding = self.embeddings.embed_query(query)
+        with instrumentation.span('vector_search', retriever='contract_keys'):
+            with self.driver.session(database=self.database) as session:
+                records = session.run(keys_query, keys=keys, embedding=embedding, k=k, window=self.window).data()
+        return self.documents(records)
+
+    def documents(self, records):
+        return [Document(page_content=record["text"] or "",
+                         metadata={**record["metadata"], "documentName": self.doc_name,
+                                   "score": record["score"], "source": self.doc_name})
+                for record in records]
@@ -0,0 +1,55 @@
+import os
+import sys
+import time
+from langchain.callbacks.base import BaseCallbackHandler
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import instrumentation
+
+class StageTimer(BaseCallbackHandler):
+    """Callback handler that records the stages of one chat request from the
+    callbacks of the chain: the retrieval (only the outermost retriever, the
+    wrapped ones are recorded by their own spans), the prompt build (from the end
+    of the retrieval to the start of the llm), the time to the first token of the
+    llm and the whole llm call. A new instance is used for each request"""
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.retrievers = set()
+        self.retrieval_start = {}
+        self.retrieval_end = None
+        self.llm_start = None
+        self.first_token = False
+
+    def on_retriever_start(self, serialized, query, *, run_id, parent_run_id=None, **kwargs):
+        if parent_run_id not in self.retrievers:
+            self.retrieval_start[run_id] = time.perf_counter()
+        self.retrievers.add(run_id)
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        start = self.retrieval_start.pop(run_id, None)
+        if start is not None:
+            self.retrieval_end = time.perf_counter()
+            instrumentation.observe('chat_retrieval', self.retrieval_end - start, mode=self.mode)
+            instrumentation.count('chat_retrieved_documents', len(documents), mode=self.mode)
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        if self.retrieval_start.pop(run_id, None) is not None:
+            instrumentation.count('chat_errors', stage='retrieval', mode=self.mode)
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.llm_start = time.perf_counter()
+        if self.retrieval_end is not None:
+            instrumentation.observe('chat_prompt', self.llm_start - self.retrieval_end, mode=self.mode)
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        # Cached answers are replayed without an llm call, so there is no llm_start
+        if not self.first_token and self.llm_start is not None:
+            self.first_token = True
+            instrumentation.observe('chat_llm_first_token', time.perf_counter() - self.llm_start, mode=self.mode)
+
+    def on_llm_end(self, response, **kwargs):
+        if self.llm_start is not None:
+            instrumentation.observe('chat_llm', time.perf_counter() - self.llm_start, mode=self.mode)
+
+    def on_llm_error(self, error, **kwargs):
+        instrumentation.count('chat_errors', stage='llm', mode=self.mode)
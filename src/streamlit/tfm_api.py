@@ -1,12 +1,17 @@
-import pandas as pd
-from datetime import datetime
-import os
+import threading
 import streamlit as st
 from streamlit.logger import get_logger
+from streamlit.runtime.scriptrunner import add_script_run_ctx
 from langchain.callbacks.base import BaseCallbackHandler
-from langchain_community.graphs.neo4j_graph import Neo4jGraph
 from utils import extract_title_and_question
-from chains_rag import load_embedding, load_llm, llm_chain, qa_rag_chain, llm_ticket
+from chains_rag import load_embedding, load_llm, llm_chain as create_llm_chain, qa_rag_chain, llm_ticket
+from local_index import load_local_index
+from lexical_index import load_lexical_index
+from answer_cache import AnswerCache, cached_chain
+from stage_timer import StageTimer
+from neo4j_driver import get_driver
+import instrumentation
+from report_log import rag_reports, ticket_reports
 
 import sys
 sys.path.append('/Users/nfanlo/dev')
@@ -17,17 +22,93 @@ NEO4J_USER = "neo4j"
 NEO4J_DATABASE = "neo4j"
 NEO4J_PASSWORD = config["neo4j_password"]
 NEO4J_URL = config["neo4j_url"]
-neo4j_graph = Neo4jGraph(url=NEO4J_URL, username=NEO4J_USER, password=NEO4J_PASSWORD, database=NEO4J_DATABASE)
+
+# Process-wide cache of the chains shared by every session: a rerun reuses the
+# warm chains of the same (llm name, contract name) until they expire or are evicted
+CHAIN_CACHE_TTL = 3600 #Seconds
+CHAIN_CACHE_ENTRIES = 32
+# Search the chunks in an in-process copy of the Embedding vectors instead of the Neo4j vector index
+USE_LOCAL_INDEX = False
+LOCAL_INDEX_TTL = 600 #Seconds between refreshes of the local vector index
+# Fuse the BM25 hits of the local lexical index with the vector hits, and optionally
+# score with the vectors only the chunks that match the terms of the question
+USE_LEXICAL_INDEX = False
+LEXICAL_PREFILTER = False
+# Reuse the answers of questions similar to a cached one, not only the identical ones
+SEMANTIC_ANSWER_CACHE = True
 
 logger = get_logger(__name__)
 
 llm_name = 'gpt-3.5'
 embed_model_id = 'sentence-transformers/all-MiniLM-L6-v2'
 
-llm = load_llm(llm_name, logger=logger)
-embeddings, dimension = load_embedding(logger=logger)
+@st.cache_resource
+def get_llm(llm_name):
+    return load_llm(llm_name, logger=logger)
+
+@st.cache_resource
+def get_embeddings():
+    return load_embedding(logger=logger)
+
+@st.cache_resource(ttl=LOCAL_INDEX_TTL)
+def get_local_index(dimension):
+    return load_local_index(NEO4J_URL, NEO4J_USER, NEO4J_PASSWORD, dimension)
+
+@st.cache_resource(ttl=LOCAL_INDEX_TTL)
+def get_lexical_index():
+    return load_lexical_index(NEO4J_URL, NEO4J_USER, NEO4J_PASSWORD)
+
+@st.cache_resource
+def get_llm_chain(llm_name):
+    return create_llm_chain(get_llm(llm_name))
+
+@st.cache_resource(ttl=CHAIN_CACHE_TTL, max_entries=CHAIN_CACHE_ENTRIES)
+def get_rag_chain(llm_name, contract_name):
+    """Function that returns the cached rag_chain of a contract, 
+    building it only the first time it is requested"""
+
+    embeddings, dimension = get_embeddings()
+    # The chain outlives the indexes (LOCAL_INDEX_TTL < CHAIN_CACHE_TTL), so it gets their
+    # getters: each search uses the index refreshed with the contracts ingested since then
+    local_index = (lambda: get_local_index(dimension)) if USE_LOCAL_INDEX else None
+    lexical_index = get_lexical_index if USE_LEXICAL_INDEX else None
+    return qa_rag_chain(get_llm(llm_name), embeddings, doc_name=contract_name, embeddings_url=NEO4J_URL, username=NEO4J_USER, password=NEO4J_PASSWORD, database=NEO4J_DATABASE, local_index=local_index, lexical_index=lexical_index, lexical_prefilter=LEXICAL_PREFILTER)
+
+def contract_version(contract_name):
+    """Function that returns the last ingestion time of a contract, 
+    used to drop its cached answers when it is ingested again"""
+
+    try:
+        with get_driver(NEO4J_URL, NEO4J_USER, NEO4J_PASSWORD).session() as session:
+            record = session.run("MATCH (d:Document {name: $name}) RETURN max(d.updated_at) AS version", name=contract_name).single()
+        return record["version"]
+    except Exception as e:
+        logger.info(f"Contract version not available: {e}")
+        return None
+
+@st.cache_resource
+def get_answer_cache():
+    embeddings, dimension = get_embeddings()
+    return AnswerCache(embeddings=embeddings if SEMANTIC_ANSWER_CACHE else None, version_fn=contract_version)
+
+@st.cache_resource
+def start_warmup():
+    """Function that loads the embedding model and the llm chain in a background
+    thread, once per process, while the login page is shown. The cached functions
+    wait for the warmup when a session needs them before it has finished"""
+
+    def warmup():
+        try:
+            get_embeddings()
+            get_llm_chain(llm_name)
+        except Exception as e:
+            logger.info(f"Warmup failed: {e}")
+
+    thread = threading.Thread(target=warmup, daemon=True)
+    add_script_run_ctx(thread)
+    thread.start()
+    return thread
 
-llm_chain = llm_chain(llm)
 rag_chain = None
 
 def initialize_rag_chain(contract_name):
@@ -35,34 +116,17 @@ def initialize_rag_chain(contract_name):
     RAG mode button is activated"""
 
     global rag_chain
-    rag_chain = qa_rag_chain(llm, embeddings, doc_name=contract_name, embeddings_url=NEO4J_URL, username=NEO4J_USER, password=NEO4J_PASSWORD, database=NEO4J_DATABASE)
+    rag_chain = get_rag_chain(llm_name, contract_name)
 
 def update_rag_reports(user_input, assistant_llm_chain, assistant_rag_chain, contract_name, username):
     """Function to update the rag reports in the corresponding 
-    csv for subsequent support analysis"""
+    log for subsequent support analysis. The csv is exported with report_log.py"""
 
-    csv_path = "dashboard-data/rag-reports.csv"
-    if not os.path.exists("dashboard-data"):
-        os.makedirs("dashboard-data")
-    try:
-        df_rag_reports = pd.read_csv(csv_path)
-    except FileNotFoundError:
-        df_rag_reports = pd.DataFrame(columns=['Index', 'Date', 'Document', 'User_Input', 'Assistant_llm_chain', 'Assistant_rag_chain', 'User'])
-        df_rag_reports.to_csv(csv_path, index=False)
-
-    index_counter = len(df_rag_reports) + 1
-    now = datetime.now()
-    date_time = now.strftime("%Y-%m-%d %H:%M:%S")
-    new_row = {'Index': index_counter, 
-               'Date': date_time, 
-               'Document': contract_name, 
-               'User_Input': user_input,
-               'Assistant_llm_chain': assistant_llm_chain, 
-               'Assistant_rag_chain': assistant_rag_chain,
-               'User': username}
-
-    df_rag_reports = pd.concat([df_rag_reports, pd.DataFrame([new_row])], ignore_index=True)
-    df_rag_reports.to_csv(csv_path, index=False)
+    rag_reports.log(Document=contract_name,
+                    User_Input=user_input,
+                    Assistant_llm_chain=assistant_llm_chain,
+                    Assistant_rag_chain=assistant_rag_chain,
+                    User=username)
 
 class StreamHandler(BaseCallbackHandler):
     def __init__(self, container, initial_text=""):
@@ -90,6 +154,7 @@ def chat_input(name):
         with st.chat_message("user"):
             st.write(user_input)
 
+        output_function = get_output_function(name)
         if output_function is None:
             st.error("La función de salida no está definida.")
             return
@@ -97,13 +162,18 @@ def chat_input(name):
         with st.chat_message("assistant"):
             st.caption(f"RAG: {name}")
             stream_handler = StreamHandler(st.empty())
+            mode = "rag" if name == "Activado" else "llm"
+            instrumentation.count('chat_requests', mode=mode)
             try:
-                result = output_function({
-                    "input_text": user_input,
-                    "question": user_input,
-                    "chat_history": [],
-                    "contract_name": st.session_state['contract_name']
-                }, callbacks=[stream_handler])["answer"]
+                contract_name = st.session_state['contract_name'] if name == "Activado" else ""
+                answer_function = cached_chain(output_function, get_answer_cache(), name, contract_name)
+                with instrumentation.span('chat_total', mode=mode):
+                    result = answer_function({
+                        "input_text": user_input,
+                        "question": user_input,
+                        "chat_history": [],
+                        "contract_name": st.session_state['contract_name']
+                    }, callbacks=[stream_handler, StageTimer(mode)])["answer"]
             except Exception as e:
                 st.error(f"Error al generar la respuesta: {str(e)}")
                 return
@@ -114,7 +184,8 @@ def chat_input(name):
                 st.session_state["generated"].append(output)
                 st.session_state["rag_mode"].append(name)
 
-                update_rag_reports(user_input, "", output if name == "Activado" else "", st.session_state['contract_name'], st.session_state['username'])
+                with instrumentation.span('chat_report', mode=mode):
+                    update_rag_reports(user_input, "", output if name == "Activado" else "", st.session_state['contract_name'], st.session_state['username'])
             else:
                 st.error("No se pudo generar una respuesta.")
 
@@ -159,20 +230,20 @@ if 'contract_name' not in st.session_state:
 
 name = mode_select()
 
-output_function = None
-if name == "Desactivado":
-    output_function = llm_chain
-elif name == "Activado":
-    output_function = rag_chain
+def get_output_function(name):
+    if name == "Desactivado":
+        return get_llm_chain(llm_name)
+    return rag_chain
 
-if name == "Activado" and output_function is None:
+if name == "Activado" and rag_chain is None:
     st.error("El campo se encuentra vacío. Introduzca el nombre del contrato.")
 
 def generate_ticket():
     q_prompt = st.session_state["user_input"][-1] if st.session_state["user_input"] else "No input provided"
     n_contract = st.session_state["contract_name"] if st.session_state["contract_name"] else "No contract name provided"
 
-    llm_response = llm_ticket(q_prompt, llm)
+    with instrumentation.span('ticket'):
+        llm_response = llm_ticket(q_prompt, get_llm(llm_name))
     
     new_title, new_question = extract_title_and_question(llm_response["answer"])
     return q_prompt, new_title, new_question, n_contract
@@ -180,26 +251,11 @@ def generate_ticket():
 def close_sidebar():
     q_prompt, new_title, new_question, n_contract = generate_ticket()
 
-    csv_path = "dashboard-data/ticket-reports.csv"
-    if not os.path.exists("dashboard-data"):
-        os.makedirs("dashboard-data")
-    if not os.path.exists(csv_path):
-        df_ticket_reports = pd.DataFrame(columns=['Index', 'Date', 'User', 'Document', 'Original_title_question', 'New_title_question', 'New_user_question'])
-        df_ticket_reports.to_csv(csv_path, index=False)
-    else:
-        try:
-            df_ticket_reports = pd.read_csv(csv_path)
-        except pd.errors.EmptyDataError:
-            df_ticket_reports = pd.DataFrame(columns=['Index', 'Date', 'User', 'Document' 'Original_title_question', 'New_title_question', 'New_user_question'])
-    index_counter = len(df_ticket_reports) + 1
-    now = datetime.now()
-    date_time = now.strftime("%Y-%m-%d %H:%M:%S")
-    username = st.session_state['username']
-    new_row = {'Index': index_counter, 'Date': date_time, 'User': username, 'Original_title_question': q_prompt,
-               'New_title_question': new_title, 'New_user_question': new_question, 'Document': n_contract}
-    
-    df_ticket_reports = pd.concat([df_ticket_reports, pd.DataFrame([new_row])], ignore_index=True)
-    df_ticket_reports.to_csv(csv_path, index=False)
+    ticket_reports.log(User=st.session_state['username'],
+                       Document=n_contract,
+                       Original_title_question=q_prompt,
+                       New_title_question=new_title,
+                       New_user_question=new_question)
     st.session_state.open_sidebar = False
 
 def open_sidebar():
@@ -229,6 +285,7 @@ if 'login_button' not in st.session_state:
     st.session_state['login_button'] = False
 
 if st.session_state['username'] == '' and not st.session_state['login_button']:
+    start_warmup()
     st.title("Iniciar sesión")
     st.text_input("Usuario", key='username_input')
     if st.button("Entrar"):